@@ -0,0 +1,369 @@
+import asyncio
+import json
+from urllib.parse import parse_qsl
+
+import serializer
+from events import KEEPALIVE, KEEPALIVE_COMMENT, RETRY, event_payload, format_event
+from journal import JournalStore
+from server import (
+    new_session_game, run_batch, validate_action, validate_batch, validate_players, validate_query,
+    transaction_query, score_rows, EXPORT_CHUNK_SIZE, EXPORT_QUERY_FIELDS, STATEMENT_QUERY_FIELDS,
+)
+
+# asyncio variant of the game api, same routes and the same Database engine as server.py.
+# idle connections cost a socket, not a worker thread. run with:
+#   uvicorn asgi_server:app
+
+
+# session name -> Database, with one asyncio lock per session.
+# handlers only await between export chunks, but the lock keeps a turn whole if that changes.
+# durable with a JournalStore, like SessionManager
+class AsyncSessionManager:
+
+    def __init__(self, store=None):
+        self.dbs = {}
+        self.locks = {}
+        self.store = store
+        self.changed = {}  # session -> asyncio.Event set at its next write, see events.py
+        self.events = {}  # session -> since -> encoded event for the session as it is now
+        if store is not None:
+            for session in store.sessions():
+                self.dbs[session] = store.load(session)
+                self.locks[session] = asyncio.Lock()
+
+    async def create(self, session, db):
+        lock = self.locks.setdefault(session, asyncio.Lock())
+        async with lock:
+            if self.store is not None:
+                self.store.attach(session, db)
+            self.dbs[session] = db
+            self.publish(session)
+
+    # wakes the session's event streams
+    def publish(self, session):
+        self.events.pop(session, None)
+        changed = self.changed.pop(session, None)
+        if changed is not None:
+            changed.set()
+
+    def changed_event(self, session):
+        return self.changed.setdefault(session, asyncio.Event())
+
+    # every stream at the same version shares one encoding
+    def event(self, session, db, since):
+        events = self.events.setdefault(session, {})
+        event = events.get(since)
+        if event is None:
+            event = events[since] = format_event(db.cursor(), event_payload(db, since))
+        return event
+
+    def __contains__(self, session):
+        return session in self.dbs
+
+
+sessions = AsyncSessionManager(JournalStore.from_env())
+
+
+# route handlers take (db, json body, query args) and return something the serializer can encode,
+# json bytes that are already encoded, or (body, status)
+def get_location(db, data, args):
+    return db.board_payloads().locations[data["idx"]]
+
+
+def run_action(db, data, args):
+    player_ids = data["player_ids"] if "player_ids" in data else [data["player_id"]]
+    for player_id in player_ids:
+        error = validate_action(db, data["action"], player_id)
+        if error is not None:
+            return {"error": error}, 400
+    if "player_ids" in data:
+        db.run_action_many(data["action"], player_ids)
+    else:
+        db.run_action(data["action"], data["player_id"])
+    return {"status": "ok"}
+
+
+def add_player(db, data, args):
+    return db.new_player(data["name"])
+
+
+def find_player_by_name(db, data, args):
+    return db.find_player_by_name(data["name"])
+
+
+def get_player(db, data, args):
+    return db.get_player(data["id"])
+
+
+def add_debt(db, data, args):
+    return db.new_debt(data["debtee_id"], data["start_turn"], data["amount"], data["interest_rate"], data["loaner_id"])
+
+
+def get_debt(db, data, args):
+    return db.get_debt(data["id"])
+
+
+def get_player_debts(db, data, args):
+    return db.get_player_debts(data["player_id"])
+
+
+def borrow_debt(db, data, args):
+    db.borrow_debt(data["player_id"], data["amount"])
+    return {"status": "ok"}
+
+
+def repay_debt(db, data, args):
+    db.repay_debt(data["debt_id"], data["debtee_id"], data["amount"])
+    return {"status": "ok"}
+
+
+def move_player_rel(db, data, args):
+    player = db.get_player(data["player_id"])
+    db.move_player_rel(db, player, data["n"])
+    return db.board_payloads().locations[player.location_idx]
+
+
+def move_player_abs(db, data, args):
+    db.move_player_abs(db, data["player_id"], data["location_idx"])
+    return db.board_payloads().locations[data["location_idx"]]
+
+
+def add_transaction(db, data, args):
+    return db.new_transaction(data)
+
+
+def get_transactions(db, data, args):
+    error = validate_query(args)
+    if error is not None:
+        return {"error": error}, 400
+    return db.query_transactions(**transaction_query(args))
+
+
+def changes(db, data, args):
+    return db.changes(args.get("since", ""))
+
+
+def player_score(db, data, args):
+    return {"score": db.player_score(data["id"])}
+
+
+def scores(db, data, args):
+    return {"scores": score_rows(db)}
+
+
+def player_money(db, data, args):
+    return {"money": db.player_money(data["id"])}
+
+
+def player_bank_statement(db, data, args):
+    error = validate_query(data, STATEMENT_QUERY_FIELDS)
+    if error is not None:
+        return {"error": error}, 400
+    return db.bank_statement(data["player_id"], **transaction_query(data, STATEMENT_QUERY_FIELDS))
+
+
+def batch(db, data, args):
+    ops = data["ops"]
+    error = validate_batch(db, ops)
+    if error is not None:
+        return {"error": error}, 400
+    return {"results": run_batch(db, ops)}
+
+
+def player_advance_turn(db, data, args):
+    player_ids = data["player_ids"] if "player_ids" in data else [data["player_id"]]
+    error = validate_players(db, player_ids)
+    if error is not None:
+        return {"error": error}, 400
+    if "player_ids" in data:
+        db.advance_turns(player_ids)
+    else:
+        db.player_advance_turn(data["player_id"])
+    return {"status": "ok"}
+
+
+# route name -> (http method, handler)
+ROUTES = {
+    "get_location": ("POST", get_location),
+    "run_action": ("POST", run_action),
+    "add_player": ("POST", add_player),
+    "find_player_by_name": ("POST", find_player_by_name),
+    "get_player": ("POST", get_player),
+    "add_debt": ("POST", add_debt),
+    "get_debt": ("POST", get_debt),
+    "get_player_debts": ("POST", get_player_debts),
+    "borrow_debt": ("POST", borrow_debt),
+    "repay_debt": ("POST", repay_debt),
+    "move_player_rel": ("POST", move_player_rel),
+    "move_player_abs": ("POST", move_player_abs),
+    "add_transaction": ("POST", add_transaction),
+    "get_transactions": ("GET", get_transactions),
+    "changes": ("GET", changes),
+    "player_score": ("POST", player_score),
+    "scores": ("GET", scores),
+    "player_money": ("POST", player_money),
+    "player_bank_statement": ("POST", player_bank_statement),
+    "batch": ("POST", batch),
+    "player_advance_turn": ("POST", player_advance_turn),
+}
+
+
+async def send_body(send, body, status=200, content_type=b"application/json", headers=()):
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, obj, status=200):
+    await send_body(send, serializer.dumps(obj), status)
+
+
+# If-None-Match, a weak tag matches like a strong one for a GET
+def etag_matches(header, etag):
+    tags = [tag.strip().removeprefix(b"W/") for tag in header.split(b",")]
+    return b"*" in tags or etag in tags
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+# the export as one json array, chunks are encoded between awaits
+async def stream_chunks(send, chunks):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": b"[", "more_body": True})
+    for i, chunk in enumerate(chunks):
+        body = serializer.dumps(chunk)[1:-1]
+        await send({"type": "http.response.body", "body": body if i == 0 else b"," + body, "more_body": True})
+    await send({"type": "http.response.body", "body": b"]"})
+
+
+# the asyncio side of events.py, one changes event per wake-up until the client goes away
+async def stream_events(send, receive, session, cursor):
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no"),
+    ]})
+    await send({"type": "http.response.body", "body": RETRY, "more_body": True})
+    disconnected = asyncio.ensure_future(receive())
+    epoch = version = None
+    try:
+        while True:
+            changed = sessions.changed_event(session)
+            db = sessions.dbs.get(session)
+            if db is None:
+                break
+            if epoch is None:
+                epoch, version = db.epoch, db.since_version(cursor)
+            elif db.epoch != epoch:
+                epoch, version = db.epoch, 0  # a new game, send all of it
+            if db.version != version:
+                await send({"type": "http.response.body", "body": sessions.event(session, db, version), "more_body": True})
+                version = db.version
+            while True:
+                woken = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait((woken, disconnected), timeout=KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    woken.cancel()
+                    return
+                if woken in done:
+                    break
+                woken.cancel()
+                await send({"type": "http.response.body", "body": KEEPALIVE_COMMENT, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+
+
+# /_sessions/scores, see server.py. each session's lock is taken in turn
+async def session_scores(send, args):
+    names = [name for name in args.get("sessions", "").split(",") if name]
+    if not names:
+        return await send_json(send, {"error": "sessions must name at least one session"}, 400)
+    result = {}
+    for name in names:
+        if name not in sessions:
+            return await send_json(send, {"error": f"no session {name}"}, 404)
+        async with sessions.locks[name]:
+            result[name] = score_rows(sessions.dbs[name])
+    return await send_json(send, {"sessions": result})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    parts = scope["path"].strip("/").split("/")
+    if len(parts) != 2:
+        return await send_json(send, {"error": "not found"}, 404)
+    session, name = parts
+    method = scope["method"]
+    args = dict(parse_qsl(scope["query_string"].decode()))
+    body = await read_body(receive)
+
+    if session == "_sessions" and name == "scores" and method == "GET":
+        return await session_scores(send, args)
+    if name == "new" and method == "GET":
+        if session in sessions and args.get("reset") != "1":
+            return await send_json(send, {"error": f"session {session} already exists, pass reset=1 to replace it"}, 409)
+        await sessions.create(session, new_session_game(session))
+        return await send_json(send, {"status": "new game created"})
+    if name == "events" and method == "GET":
+        if session not in sessions:
+            return await send_json(send, {"error": f"no session {session}"}, 404)
+        headers = dict(scope["headers"])
+        return await stream_events(send, receive, session, headers.get(b"last-event-id", b"").decode() or args.get("since", ""))
+    if name == "board" and method == "GET":
+        if session not in sessions:
+            return await send_json(send, {"error": f"no session {session}"}, 404)
+        payloads = sessions.dbs[session].board_payloads()
+        etag = f'"{payloads.etag}"'.encode()
+        headers = [(b"etag", etag), (b"cache-control", b"no-cache")]
+        if etag_matches(dict(scope["headers"]).get(b"if-none-match", b""), etag):
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            return await send({"type": "http.response.body", "body": b""})
+        return await send_body(send, payloads.board, headers=headers)
+    if name != "export_transactions" and (name not in ROUTES or ROUTES[name][0] != method):
+        return await send_json(send, {"error": "not found"}, 404)
+    if session not in sessions:
+        return await send_json(send, {"error": f"no session {session}"}, 404)
+    if name == "export_transactions":
+        error = validate_query(args, EXPORT_QUERY_FIELDS)
+        if error is not None:
+            return await send_json(send, {"error": error}, 400)
+
+    async with sessions.locks[session]:
+        db = sessions.dbs[session]
+        if name == "export_transactions":
+            # the row bounds are fixed here, the chunks are encoded after the lock is released
+            chunks = db.transaction_chunks(EXPORT_CHUNK_SIZE, **transaction_query(args, EXPORT_QUERY_FIELDS))
+        else:
+            data = json.loads(body) if body else None
+            version = db.version
+            result = ROUTES[name][1](db, data, args)
+            db.commit()
+            if db.version != version:
+                sessions.publish(session)
+            status = 200
+            if isinstance(result, tuple):
+                result, status = result
+            encoded = result if isinstance(result, bytes) else serializer.dumps(result)
+
+    if name == "export_transactions":
+        return await stream_chunks(send, chunks)
+    await send_body(send, encoded, status)
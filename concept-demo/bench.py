@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+import server
+
+# engine and route benchmarks, compared with a stored baseline:
+#   python bench.py                  run and compare with bench_baseline.json, flags regressions
+#   python bench.py --save           run and write the baseline, merged into the cases it did not run
+#   python bench.py --full           also run 1M transaction sessions
+#   python bench.py --filter score   only the cases whose name contains "score"
+# exits 1 when a case is more than --tolerance slower than its baseline.
+# timings are per call in microseconds, best of the repeats
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+SIZES = (1_000, 10_000, 100_000)  # transactions per session
+FULL_SIZES = SIZES + (1_000_000,)
+PLAYER_COUNTS = (2, 8, 32)
+ROUTE_SESSION_SIZE = 10_000
+ROUTE_PLAYERS = 8
+DEBTS_PER_PLAYER = 10
+TURNS = 100  # turns the session's transactions are spread over
+
+
+# a session whose transactions are spread over the players and TURNS turns, with a few debts and
+# long terms each. the turns stay small so scores stay inside the sigmoid's range at any size.
+# bench_json.py and bench_logging.py build their sessions with it too
+def make_session(n, players):
+    db = server.new_game()
+    bank = db.find_player_by_name(server.BANK_NAME)
+    supermarket = db.find_player_by_name(server.SUPER_MARKET_NAME)
+    ids = []
+    for i in range(players):
+        player = server.Player.new(db.id_gen, f"Player {i}")
+        db.add_player(player)
+        ids.append(player.id)
+        db.run_action("supermarket_part_time", player.id)
+        db.run_action("get_netflex_subscription", player.id)
+
+    debt_every = max(1, n // (players * DEBTS_PER_PLAYER))
+    for i in range(n):
+        player = db.get_player(ids[i % players])
+        player.turns = i * TURNS // n
+        if i % debt_every == 0:
+            db.borrow_debt(player.id, 100)
+        elif i % 2:
+            db.add_transaction(server.Transaction.new(db.id_gen, 50, player.id, supermarket.id, "buy food", player.turns, 0.05, 0))
+        else:
+            db.add_transaction(server.Transaction.new(db.id_gen, 100, bank.id, player.id, "paycheck", player.turns, 0, 0))
+    for id in ids:
+        db.get_player(id).turns = TURNS
+    return db, ids
+
+
+# best time per call in microseconds. read-only calls are auto-ranged, calls that change the session
+# run a fixed small number of times so the session barely grows while it is measured
+def measure(fn, mutates=False, repeat=7):
+    timer = timeit.Timer(fn)
+    number = 200 if mutates else max(1, timer.autorange()[0] // 5)
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+# best single call in milliseconds, for the comparisons in bench_json.py and bench_logging.py
+def best_ms(fn, repeat=5):
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+
+def engine_cases(db, ids):
+    player_id = ids[0]
+
+    def borrow_repay():
+        db.borrow_debt(player_id, 100)
+        db.repay_debt(db.get_player_debts(player_id)[-1].id, player_id, 100)
+
+    # a round for the player, ROUND_TURNS turns with four_turner processing what came due
+    return {
+        "player_money": (lambda: db.player_money(player_id), False),
+        "player_score": (lambda: db.player_score(player_id), False),
+        "player_score_new_turn": (lambda: (db.scores.debts_changed(player_id), db.player_score(player_id)), False),
+        "all_player_scores": (db.all_player_scores, False),
+        "bank_statement_page": (lambda: db.bank_statement(player_id, limit=50), False),
+        "player_bank_statement": (lambda: db.player_bank_statement(player_id), False),
+        "round": (lambda: db.advance_turns([player_id] * server.ROUND_TURNS), True),
+        "borrow_repay": (borrow_repay, True),
+    }
+
+
+def route_cases(client, session, ids):
+    player_id = ids[0]
+    base = f"/{session}"
+    etag = client.get(f"{base}/board").headers["ETag"] if client else None
+    return {
+        "player_money": lambda: client.post(f"{base}/player_money", json={"id": player_id}),
+        "player_score": lambda: client.post(f"{base}/player_score", json={"id": player_id}),
+        "get_player": lambda: client.post(f"{base}/get_player", json={"id": player_id}),
+        "bank_statement_page": lambda: client.post(f"{base}/player_bank_statement", json={"player_id": player_id, "limit": 50}),
+        "get_transactions_page": lambda: client.get(f"{base}/get_transactions?limit=100"),
+        "scores": lambda: client.get(f"{base}/scores"),
+        "board": lambda: client.get(f"{base}/board"),
+        "board_not_modified": lambda: client.get(f"{base}/board", headers={"If-None-Match": etag}),
+        "run_action": lambda: client.post(f"{base}/run_action", json={"action": "supermarket_buy_food", "player_id": player_id}),
+        "move_player_rel": lambda: client.post(f"{base}/move_player_rel", json={"player_id": player_id, "n": 3}),
+        "player_advance_turn": lambda: client.post(f"{base}/player_advance_turn", json={"player_id": player_id}),
+        "batch_turn": lambda: client.post(f"{base}/batch", json={"ops": [
+            {"op": "move", "player_id": player_id, "n": 3},
+            {"op": "money", "player_id": player_id},
+            {"op": "advance_turn", "player_id": player_id},
+        ]}),
+    }
+
+
+def selected(name, pattern):
+    return pattern is None or pattern in name
+
+
+def run(sizes, pattern, baseline):
+    results = {}
+    for n in sizes:
+        for players in (PLAYER_COUNTS if n < 1_000_000 else (8,)):
+            names = [f"engine/{op}/t={n}/p={players}" for op in engine_cases(server.new_game(), [0])]
+            if not any(selected(name, pattern) for name in names):
+                continue
+            db, ids = make_session(n, players)
+            for op, (fn, mutates) in engine_cases(db, ids).items():
+                name = f"engine/{op}/t={n}/p={players}"
+                if selected(name, pattern):
+                    results[name] = measure(fn, mutates)
+                    report(name, results[name], baseline)
+
+    if not any(selected(f"route/{route}", pattern) for route in route_cases(None, None, [0])):
+        return results
+    session = "bench"
+    db, ids = make_session(ROUTE_SESSION_SIZE, ROUTE_PLAYERS)
+    server.sessions.create(session, db)
+    client = server.app.test_client()
+    for route, fn in route_cases(client, session, ids).items():
+        name = f"route/{route}/t={ROUTE_SESSION_SIZE}/p={ROUTE_PLAYERS}"
+        if selected(name, pattern):
+            results[name] = measure(fn, mutates=route in ("run_action", "batch_turn", "player_advance_turn", "move_player_rel"))
+            report(name, results[name], baseline)
+    return results
+
+
+def report(name, us, baseline):
+    line = f"{name:<52} {us:>12.2f} us"
+    if name in baseline:
+        ratio = us / baseline[name]
+        line += f" {baseline[name]:>12.2f} us {ratio:>6.2f}x"
+    print(line, flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the engine and routes against a stored baseline")
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--full", action="store_true", help="include 1M transaction sessions")
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="slowdown allowed before a case is flagged, small cases jitter by a few tens of percent")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    shown = {} if args.save else baseline
+    print(f"{'case':<52} {'now':>15} {'baseline':>15} {'ratio':>7}")
+
+    results = run(FULL_SIZES if args.full else SIZES, args.filter, shown)
+
+    # cases that were not run keep their old numbers
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "results": baseline | results,
+            }, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+        sys.exit(0)
+
+    regressions = [name for name, us in results.items() if name in baseline and us > baseline[name] * (1 + args.tolerance)]
+    for name in regressions:
+        print(f"REGRESSION {name}: {results[name]:.2f} us, baseline {baseline[name]:.2f} us")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,32 @@
+import json
+
+import serializer
+from bench import best_ms, make_session
+
+
+# the encoders the routes used before the serializer layer
+def old_transactions(db):
+    return f"[{",".join([t.json_encode() for t in db.get_transactions()])}]"
+
+
+def old_statement(statement):
+    return json.dumps(statement, default=lambda o: o.to_dict())
+
+
+if __name__ == "__main__":
+    print(f"backends available: {', '.join(serializer.BACKENDS)}")
+    for n in (1_000, 10_000, 100_000):
+        db, ids = make_session(n, 1)
+        player = db.get_player(ids[0])
+        statement = db.bank_statement(player.id)
+
+        print(f"\n{n} transactions")
+        print(f"  {'transaction log':<18} {'old':<8} {best_ms(lambda: old_transactions(db)):>9.2f} ms")
+        for name in serializer.BACKENDS:
+            serializer.use(name)
+            print(f"  {'transaction log':<18} {name:<8} {best_ms(lambda: serializer.dumps(list(db.get_transactions()))):>9.2f} ms")
+        print(f"  {'bank statement':<18} {'old':<8} {best_ms(lambda: old_statement(statement)):>9.2f} ms")
+        for name in serializer.BACKENDS:
+            serializer.use(name)
+            print(f"  {'bank statement':<18} {name:<8} {best_ms(lambda: serializer.dumps(statement)):>9.2f} ms")
+        serializer.use()
@@ -0,0 +1,53 @@
+import contextlib
+import logging
+import os
+
+import logs
+import server
+from bench import best_ms, make_session
+
+# score latency with the old per-item prints against the logging facility, quiet and at debug level.
+# output goes to a line-buffered os.devnull, so every line costs a write like it does on a terminal
+
+
+# the full scan as it was, printing every step
+def old_scan_player_score(db, id):
+    sum = 0
+    turns = db.get_player(id).turns
+    for t in db.transactions:
+        if t.sender_id == id:
+            sum += t.base_from_score
+        if t.reciever_id == id:
+            sum += t.base_to_score
+        sum += 0.0001 * (turns - int(t.turn)) * t.payment
+        print(f"transactions: {t.desc}, {sum}")
+    for d in db.get_player_debts(id):
+        sum += d.score_impact(db)
+        print(f"debt: {sum}")
+    for l in db.get_player_long_terms(id):
+        sum += l.receiver_score
+        print(f"long term: {sum}")
+    score = server.credit_score(sum)
+    print(sum, score)
+    return score
+
+
+if __name__ == "__main__":
+    logs.shutdown()
+    devnull = open(os.devnull, "w", buffering=1)
+    logs.configure(stream=devnull)
+    for n in (1_000, 10_000, 100_000):
+        db, ids = make_session(n, 1)
+        player = db.get_player(ids[0])
+        print(f"\n{n} transactions")
+        with contextlib.redirect_stdout(devnull):
+            printed = best_ms(lambda: old_scan_player_score(db, player.id))
+        print(f"  {'scan, print':<24} {printed:>9.2f} ms")
+        logs.configure(logging.WARNING)
+        print(f"  {'scan, logging quiet':<24} {best_ms(lambda: db.scan_player_score(player.id)):>9.2f} ms")
+        # the listener thread writes the records meanwhile, the timing is what the calling thread sees
+        logs.configure(logging.DEBUG)
+        print(f"  {'scan, logging debug':<24} {best_ms(lambda: db.scan_player_score(player.id)):>9.2f} ms")
+        logs.configure(logging.WARNING)
+        print(f"  {'player_score':<24} {best_ms(lambda: db.player_score(player.id), repeat=100):>9.4f} ms")
+    logs.shutdown()
@@ -0,0 +1,75 @@
+import timeit
+import tracemalloc
+
+import server
+
+
+# the model classes as they were before slots, kept here for comparison
+class DictPlayer:
+
+    def __init__(self, id, name, location_idx, interest_rate, turns):
+        self.name = name
+        self.location_idx = location_idx
+        self.interest_rate = interest_rate
+        self.turns = turns
+        self.id = id
+
+
+class DictTransaction:
+
+    def __init__(self, id, payment, sender_id, reciever_id, desc, turn, base_from_score, base_to_score):
+        self.payment = payment
+        self.sender_id = sender_id
+        self.reciever_id = reciever_id
+        self.desc = desc
+        self.turn = turn
+        self.base_from_score = base_from_score
+        self.base_to_score = base_to_score
+        self.id = id
+
+
+class DictDebt:
+
+    def __init__(self, id, debtee_id, start_turn, amount, interest_rate, loaner_id):
+        self.amount = amount
+        self.start_turn = start_turn
+        self.debtee_id = debtee_id
+        self.loaner_id = loaner_id
+        self.interest_rate = interest_rate
+        self.id = id
+
+
+CASES = [
+    ("Player", DictPlayer, server.Player, lambda i: (i, "Player", 0, 0.01, 0)),
+    ("Transaction", DictTransaction, server.Transaction, lambda i: (i, 1000, 10, 7, "pay rent", i, 4.0, 0)),
+    ("Debt", DictDebt, server.Debt, lambda i: (i, 10, 0, 500, 0.05, 0)),
+]
+
+
+# bytes per instance, the arguments are built up front so only the instances are counted
+def bytes_per_instance(cls, make_args, n):
+    args = [make_args(i) for i in range(n)]
+    tracemalloc.start()
+    objs = [cls(*a) for a in args]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objs
+    return size / n
+
+
+# nanoseconds per construction, best of a few runs
+def construct_ns(cls, make_args, n):
+    args = make_args(1)
+    best = min(timeit.repeat(lambda: cls(*args), number=n, repeat=5))
+    return best / n * 1e9
+
+
+if __name__ == "__main__":
+    n = 100_000
+    print(f"{'model':<12} {'dict B':>8} {'slots B':>8} {'dict ns':>8} {'slots ns':>9}")
+    for name, old, new, make_args in CASES:
+        old_bytes = bytes_per_instance(old, make_args, n)
+        new_bytes = bytes_per_instance(new, make_args, n)
+        old_ns = construct_ns(old, make_args, n)
+        new_ns = construct_ns(new, make_args, n)
+        print(f"{name:<12} {old_bytes:>8.1f} {new_bytes:>8.1f} {old_ns:>8.1f} {new_ns:>9.1f}")
@@ -0,0 +1,78 @@
+import argparse
+import contextlib
+import io
+import random
+import sys
+
+import numpy as np
+
+import server
+from simulate import POLICIES, play_turn
+
+# plays seeded games with the simulate.py policies and checks the incremental scores and balances
+# against full scans of the transaction log after every round, exits 1 on the first disagreement:
+#   python check_scores.py --games 50 --players 4 --turns 60
+# the policies borrow, repay, and sign contracts that expire, so every path that moves a score is played
+
+
+# the player ids whose score or balance disagrees with a full scan, empty when the game is consistent
+def check_game(db):
+    # scores of players deep in debt overflow the sigmoid, the scan and the aggregates saturate alike
+    with contextlib.redirect_stdout(io.StringIO()), np.errstate(over="ignore"):
+        return db.check_scores(), db.check_balances()
+
+
+# one game, checked after every round. returns (round, mismatched scores, mismatched balances) on the
+# first failure or None, and what the game covered
+def play_checked_game(seed, policies, turns):
+    rnd = random.Random(seed)
+    db = server.new_game()
+    bank = db.find_player_by_name(server.BANK_NAME)
+    players = []
+    for i, name in enumerate(policies):
+        player = server.Player.new(db.id_gen, f"{name} {i}")
+        db.add_player(player)
+        players.append((player, POLICIES[name]))
+
+    failure = None
+    for n in range(turns):
+        for player, policy in players:
+            play_turn(db, rnd, player, policy, bank)
+        scores, balances = check_game(db)
+        if scores or balances:
+            failure = (n, scores, balances)
+            break
+
+    descs = [t.desc for t in db.transactions]
+    covered = {
+        "debts": len(db.debts),
+        "repayments": descs.count("repay debt"),
+        "expired": len(db.removed_long_terms),
+    }
+    return failure, covered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check credit scores and balances against full scans in simulated games")
+    parser.add_argument("--games", type=int, default=20)
+    parser.add_argument("--players", type=int, default=4, help="players per game, they take the policies in turn")
+    parser.add_argument("--turns", type=int, default=60, help="turns per player")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    policies = list(POLICIES)
+    seats = [policies[i % len(policies)] for i in range(args.players)]
+    totals = {"debts": 0, "repayments": 0, "expired": 0}
+    failed = False
+    for seed in range(args.seed, args.seed + args.games):
+        failure, covered = play_checked_game(seed, seats, args.turns)
+        for name, count in covered.items():
+            totals[name] += count
+        if failure is not None:
+            failed = True
+            n, scores, balances = failure
+            print(f"seed {seed}, round {n}: scores disagree for {scores}, balances disagree for {balances}")
+
+    print(f"{args.games} games, {totals['debts']} debts, {totals['repayments']} repayments, "
+          f"{totals['expired']} expired long terms, {'BROKEN' if failed else 'ok'}")
+    sys.exit(1 if failed else 0)
@@ -6,7 +6,7 @@ BASE_URL = "http://localhost:5000"
 SESSION = "testsession"
 
 # Initialize game session on server
-requests.get(f"{BASE_URL}/{SESSION}/new")
+requests.get(f"{BASE_URL}/{SESSION}/new?reset=1")
 
 # Create players
 p1 = requests.post(f"{BASE_URL}/{SESSION}/add_player", json={"name": "Player 1"}).json()
@@ -169,8 +169,11 @@ Remember:
             print("invalid action")
             continue
 
-        money = requests.post(f"{BASE_URL}/{SESSION}/player_money", json={"id": player["id"]}).json()["money"]
+        # end of turn in one round trip
+        results = requests.post(f"{BASE_URL}/{SESSION}/batch", json={"ops": [
+            {"op": "money", "player_id": player["id"]},
+            {"op": "advance_turn", "player_id": player["id"]},
+        ]}).json()["results"]
+        money = results[0]["money"]
         print(f"{player['name']} has money: {money}")
 
-        requests.post(f"{BASE_URL}/{SESSION}/player_advance_turn", json={"player_id": player["id"]})
-
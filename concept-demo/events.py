@@ -0,0 +1,97 @@
+import threading
+
+import serializer
+
+# server-sent events for a session, so clients are pushed what changed instead of polling after every
+# action. every write to a session wakes its streams, each sends one "changes" event with the delta
+# since the version it sent last, the same payload as /<session>/changes plus the changed players'
+# scores. the event id is the session's cursor, a reconnecting EventSource resumes from it with
+# Last-Event-ID, and a cursor from an earlier game gets the new game whole.
+# streams that missed several writes get them merged into one event
+
+KEEPALIVE = 15  # seconds between comments on an idle stream, so dead connections are noticed
+KEEPALIVE_COMMENT = b": keepalive\n\n"
+RETRY = b"retry: 2000\n\n"  # reconnect delay for EventSource, sent first so the headers go out at once
+
+
+def event_payload(db, since):
+    changes = db.changes_since(since)
+    scores = db.all_player_scores() if changes["players"] else {}
+    changes["scores"] = [{"id": p.id, "score": scores[p.id]} for p in changes["players"]]
+    return changes
+
+
+def format_event(cursor, payload):
+    return b"id: %s\nevent: changes\ndata: %s\n\n" % (cursor.encode(), serializer.dumps(payload))
+
+
+# one session's streams. seq counts writes, it only ever goes up
+class Channel:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.events = {}  # since -> encoded event for the session as it is now
+
+
+class EventHub:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def channel(self, session):
+        with self.lock:
+            channel = self.channels.get(session)
+            if channel is None:
+                channel = self.channels[session] = Channel()
+            return channel
+
+    # called by the session manager under the session's write lock, after every write and new game
+    def publish(self, session):
+        channel = self.channel(session)
+        with channel.condition:
+            channel.seq += 1
+            channel.events = {}
+            channel.condition.notify_all()
+
+    # blocks until the session is written after seq or the timeout passes, returns the latest seq
+    def wait(self, session, seq, timeout):
+        channel = self.channel(session)
+        with channel.condition:
+            channel.condition.wait_for(lambda: channel.seq != seq, timeout)
+            return channel.seq
+
+    # the encoded event for a client at version since, called under the session's read lock so the
+    # session does not change while it is built. every stream at the same version shares one encoding
+    def event(self, session, db, since):
+        channel = self.channel(session)
+        event = channel.events.get(since)
+        if event is None:
+            event = channel.events[since] = format_event(db.cursor(), event_payload(db, since))
+        return event
+
+    # a stream from the client's cursor, until the session is removed. the read lock is only held while
+    # an event is built, never while it is sent to a slow client
+    def stream(self, sessions, session, cursor):
+        channel = self.channel(session)
+        epoch = version = None
+        yield RETRY
+        while True:
+            seq = channel.seq
+            try:
+                with sessions.read(session) as db:
+                    if epoch is None:
+                        epoch, version = db.epoch, db.since_version(cursor)
+                    elif db.epoch != epoch:
+                        epoch, version = db.epoch, 0  # a new game, send all of it
+                    event = None
+                    if db.version != version:
+                        event = self.event(session, db, version)
+                        version = db.version
+            except KeyError:
+                return
+            if event is not None:
+                yield event
+            while self.wait(session, seq, KEEPALIVE) == seq:
+                yield KEEPALIVE_COMMENT
@@ -0,0 +1,247 @@
+import functools
+import os
+import pickle
+import struct
+import threading
+from urllib.parse import quote, unquote
+
+# durable sessions: every top-level Database mutation is appended to a per-session log,
+# and a background thread writes and fsyncs all pending records together every FLUSH_INTERVAL,
+# so a request never waits on the disk. a crash loses at most the last interval.
+#
+# layout under the data dir, one directory per session:
+#   s-<session>/snapshot      pickled (generation, Database)
+#   s-<session>/<gen>.log     length-prefixed pickled (method name, args) records
+# recovery loads the snapshot and replays the logs from its generation on.
+# a snapshot starts a new generation, older logs are deleted once it is on disk
+
+FLUSH_INTERVAL = 0.05  # seconds between group commits
+SNAPSHOT_EVERY = 10000  # records before a session is snapshotted again
+
+_LENGTH = struct.Struct("<I")
+
+
+# stands in for the Database itself in recorded arguments, e.g. move_player_abs(db, ...)
+class SELF:
+    pass
+
+
+# the name of a record for a call that raised, its args are the call's own pickled record
+class FAILED:
+    pass
+
+
+# records a Database method call in the session's journal. only the outermost call is recorded,
+# the mutations it makes internally are reproduced when it is replayed. a call that raises is
+# recorded only if it changed the session first, and its replay is expected to raise the same way
+def journaled(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if self.journal is None or self.journal_depth:
+            return method(self, *args)
+        # pickled before the call, which may mutate the arguments
+        data = pickle.dumps((name, tuple(SELF if a is self else a for a in args)), protocol=pickle.HIGHEST_PROTOCOL)
+        mark = self.change_mark()
+        self.journal_depth += 1
+        try:
+            result = method(self, *args)
+        except Exception:
+            if self.change_mark() != mark:
+                self.journal.record(self, pickle.dumps((FAILED, data), protocol=pickle.HIGHEST_PROTOCOL))
+            raise
+        finally:
+            self.journal_depth -= 1
+        self.journal.record(self, data)
+        return result
+
+    return wrapper
+
+
+def replay(db, name, args):
+    if name is FAILED:
+        try:
+            replay(db, *pickle.loads(args))
+        except Exception:
+            pass
+        return
+    getattr(db, name)(*(db if a is SELF else a for a in args))
+
+
+# the pending writes for one session, filled by requests and drained by the flusher
+class SessionJournal:
+
+    def __init__(self, store, session, generation):
+        self.store = store
+        self.session = session
+        self.generation = generation
+        self.records = 0  # since the last snapshot
+        self.pending = []  # ("log", generation, bytearray) and ("snapshot", generation, bytes), in order
+
+    # called under the session's write lock with one pickled (name, args) record
+    def record(self, db, data):
+        with self.store.lock:
+            if self.pending and self.pending[-1][0] == "log":
+                buffer = self.pending[-1][2]
+            else:
+                buffer = bytearray()
+                self.pending.append(("log", self.generation, buffer))
+            buffer += _LENGTH.pack(len(data))
+            buffer += data
+            self.store.dirty.add(self)
+        self.records += 1
+        if self.records >= self.store.snapshot_every:
+            self.snapshot(db)
+
+    # also called under the session's write lock, so the pickled state is consistent
+    def snapshot(self, db):
+        self.generation += 1
+        self.records = 0
+        data = pickle.dumps((self.generation, db), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.store.lock:
+            self.pending.append(("snapshot", self.generation, data))
+            self.store.dirty.add(self)
+
+
+class JournalStore:
+
+    def __init__(self, data_dir, flush_interval=FLUSH_INTERVAL, snapshot_every=SNAPSHOT_EVERY):
+        self.data_dir = data_dir
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()  # guards dirty and every journal's pending list
+        self.dirty = set()
+        self.io_lock = threading.Lock()  # one flush at a time
+        self.stopped = threading.Event()
+        os.makedirs(data_dir, exist_ok=True)
+        self._start_flusher()
+        os.register_at_fork(after_in_child=self._restart_in_child)
+
+    def _start_flusher(self):
+        self.flusher = threading.Thread(target=self._flush_loop, name="journal-flusher", daemon=True)
+        self.flusher.start()
+
+    # a forked process, e.g. a shard.py worker, has the store but not the flusher thread. records
+    # still pending belong to the parent, which writes them itself
+    def _restart_in_child(self):
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        for journal in self.dirty:
+            journal.pending = []
+        self.dirty = set()
+        if not self.stopped.is_set():
+            self._start_flusher()
+
+    # None unless WHACK_DATA_DIR is set
+    @classmethod
+    def from_env(cls):
+        data_dir = os.environ.get("WHACK_DATA_DIR")
+        return cls(data_dir) if data_dir else None
+
+    def _session_dir(self, session):
+        return os.path.join(self.data_dir, "s-" + quote(session, safe=""))
+
+    def sessions(self):
+        return [unquote(name[2:]) for name in sorted(os.listdir(self.data_dir)) if name.startswith("s-")]
+
+    # starts journaling a session from its current state, replacing anything on disk for it
+    def attach(self, session, db):
+        self.drop(session)
+        journal = SessionJournal(self, session, 0)
+        db.journal = journal
+        journal.snapshot(db)
+        self.flush()
+        return journal
+
+    # the session as of its last flushed record, journaling again from a fresh snapshot if logs were replayed
+    def load(self, session):
+        path = self._session_dir(session)
+        with open(os.path.join(path, "snapshot"), "rb") as f:
+            generation, db = pickle.load(f)
+        logs = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith(".log"))
+        replayed = [gen for gen in logs if gen >= generation]
+        for gen in replayed:
+            with open(os.path.join(path, f"{gen}.log"), "rb") as f:
+                for name, args in self._records(f.read()):
+                    replay(db, name, args)
+
+        journal = SessionJournal(self, session, max([generation] + logs))
+        db.journal = journal
+        if replayed:
+            # the last log may end in a torn record, so carry on in a new generation
+            journal.snapshot(db)
+            self.flush()
+        return db
+
+    @staticmethod
+    def _records(data):
+        pos = 0
+        while pos + _LENGTH.size <= len(data):
+            (length,) = _LENGTH.unpack_from(data, pos)
+            end = pos + _LENGTH.size + length
+            if end > len(data):
+                return  # crashed mid-write
+            yield pickle.loads(data[pos + _LENGTH.size:end])
+            pos = end
+
+    def drop(self, session):
+        with self.lock:
+            for journal in [j for j in self.dirty if j.session == session]:
+                self.dirty.discard(journal)
+                journal.pending.clear()
+        with self.io_lock:
+            path = self._session_dir(session)
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    os.remove(os.path.join(path, name))
+                os.rmdir(path)
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    # writes every pending record and snapshot, one fsync per touched file
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                work = [(journal.session, journal.pending) for journal in self.dirty]
+                for journal in self.dirty:
+                    journal.pending = []
+                self.dirty = set()
+            for session, pending in work:
+                self._write(session, pending)
+
+    def _write(self, session, pending):
+        path = self._session_dir(session)
+        os.makedirs(path, exist_ok=True)
+        for kind, generation, data in pending:
+            if kind == "log":
+                with open(os.path.join(path, f"{generation}.log"), "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            else:
+                tmp = os.path.join(path, "snapshot.tmp")
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, os.path.join(path, "snapshot"))
+                _fsync_dir(path)
+                for name in os.listdir(path):
+                    if name.endswith(".log") and int(name[:-4]) < generation:
+                        os.remove(os.path.join(path, name))
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,141 @@
+import argparse
+import http.client
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+# load test comparing the flask app with the asgi variant. by default both are started locally:
+#   python loadtest.py --clients 32 --seconds 10 --idle 200
+# or point it at running servers with --flask http://host:port --asgi http://host:port
+
+
+def wait_for_port(host, port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on {host}:{port} did not start")
+
+
+def spawn(kind, port):
+    if kind == "flask":
+        cmd = [sys.executable, "-m", "flask", "--app", "server", "run", "--port", str(port), "--with-threads"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "asgi_server:app", "--port", str(port), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port("127.0.0.1", port)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+class Client:
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+
+    def call(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        self.conn.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+        response = self.conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path}: {response.status}")
+        return json.loads(data)
+
+
+# one client plays turns for its own player until the deadline, recording every request
+def play(url, session, player_id, deadline, latencies, errors):
+    client = Client(url)
+    turn = [
+        ("POST", f"/{session}/move_player_rel", {"player_id": player_id, "n": 3}),
+        ("POST", f"/{session}/run_action", {"action": "do_nothing", "player_id": player_id}),
+        ("POST", f"/{session}/player_money", {"id": player_id}),
+        ("POST", f"/{session}/player_score", {"id": player_id}),
+        ("POST", f"/{session}/player_advance_turn", {"player_id": player_id}),
+    ]
+    while time.monotonic() < deadline:
+        for method, path, body in turn:
+            start = time.perf_counter()
+            try:
+                client.call(method, path, body)
+            except Exception as e:
+                errors.append(repr(e))
+                client = Client(url)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def run(url, clients, seconds, tables, idle):
+    setup = Client(url)
+    players = []
+    for t in range(tables):
+        session = f"load-{t}"
+        setup.call("GET", f"/{session}/new?reset=1")
+        for c in range(t, clients, tables):
+            players.append((session, setup.call("POST", f"/{session}/add_player", {"name": f"client {c}"})["id"]))
+
+    # tables that are connected but not playing
+    parts = urlsplit(url)
+    idle_sockets = [socket.create_connection((parts.hostname, parts.port)) for _ in range(idle)]
+
+    latencies, errors = [], []
+    deadline = time.monotonic() + seconds
+    threads = [
+        threading.Thread(target=play, args=(url, session, player_id, deadline, latencies, errors))
+        for session, player_id in players
+    ]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    for s in idle_sockets:
+        s.close()
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the flask and asgi game servers under load")
+    parser.add_argument("--flask", help="url of a running flask server, started locally if omitted")
+    parser.add_argument("--asgi", help="url of a running asgi server, started locally if omitted")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--tables", type=int, default=8)
+    parser.add_argument("--idle", type=int, default=0, help="idle connections held open during the run")
+    args = parser.parse_args()
+
+    print(f"{'server':<8} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for kind, port in (("flask", 5101), ("asgi", 5102)):
+        url = getattr(args, kind)
+        proc = None
+        if url is None:
+            proc, url = spawn(kind, port)
+        try:
+            result = run(url, args.clients, args.seconds, args.tables, args.idle)
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+        print(f"{kind:<8} {result['requests']:>9} {result['errors']:>7} {result['rps']:>9.0f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
@@ -0,0 +1,102 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# leveled, structured logging for the server. records are put on a queue by the request threads and
+# formatted and written by a listener thread, so a request never waits on stdout:
+#   WHACK_LOG_LEVEL    DEBUG, INFO, WARNING (default) or ERROR
+#   WHACK_LOG_FORMAT   json (default), one object per line, or text
+# messages use %-style args, formatted only when the record passes the level.
+# fields passed with extra={...} become keys of the json object
+
+ROOT = "whack"
+
+# the attributes every LogRecord has, anything else came in through extra
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+# formats the message in the calling thread, the args may change after the call, and leaves the rest
+# to the listener. cheaper than the stdlib prepare, which runs the formatter and copies the record
+class BufferedHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+# installs the queue handler on the whack logger once, later calls only change the level
+def configure(level=None, fmt=None, stream=None):
+    global _listener
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(level or os.environ.get("WHACK_LOG_LEVEL", "WARNING").upper())
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if (fmt or os.environ.get("WHACK_LOG_FORMAT", "json")) == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    logger.addHandler(BufferedHandler(records))
+    logger.propagate = False
+    atexit.register(shutdown)
+    os.register_at_fork(after_in_child=_restart_in_child)
+
+
+# a forked worker, e.g. simulate.py's pool, has the queue but not the listener thread
+def _restart_in_child():
+    global _listener
+    if _listener is None:
+        return
+    records = queue.SimpleQueue()
+    for handler in logging.getLogger(ROOT).handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            handler.queue = records
+    _listener = logging.handlers.QueueListener(records, *_listener.handlers)
+    _listener.start()
+
+
+# writes out everything still queued
+def shutdown():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        logger = logging.getLogger(ROOT)
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                logger.removeHandler(handler)
+        _listener = None
@@ -0,0 +1,195 @@
+import inspect
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+# optional instrumentation, on with WHACK_METRICS=1. every Database method and flask route is timed
+# into a log-bucket histogram, /metrics renders them with the session sizes in prometheus text format.
+# the sampling profiler is separate and always available, it only runs between start and stop
+
+BUCKETS_PER_OCTAVE = 8  # about 9% resolution on the quantiles
+MIN_SECONDS = 1e-7
+BUCKET_COUNT = BUCKETS_PER_OCTAVE * 32  # up to about 7 minutes
+
+
+def enabled():
+    return os.environ.get("WHACK_METRICS") == "1"
+
+
+# call count, total time and a latency histogram for one method or route
+class LatencyStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * BUCKET_COUNT
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        i = int(math.log2(seconds / MIN_SECONDS) * BUCKETS_PER_OCTAVE) if seconds > MIN_SECONDS else 0
+        self.buckets[min(i, BUCKET_COUNT - 1)] += 1
+
+    # the upper edge of the bucket holding the q-th call
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return MIN_SECONDS * 2 ** ((i + 1) / BUCKETS_PER_OCTAVE)
+        return 0.0
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}  # (kind, name) -> LatencyStats
+
+    def record(self, kind, name, seconds):
+        with self.lock:
+            stats = self.stats.get((kind, name))
+            if stats is None:
+                stats = self.stats[(kind, name)] = LatencyStats()
+            stats.record(seconds)
+
+
+registry = Registry()
+
+
+def timed(kind, name, fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            registry.record(kind, name, time.perf_counter() - start)
+
+    return wrapper
+
+
+# wraps the methods a class defines itself, subclasses are instrumented separately for their overrides
+def instrument_class(cls):
+    for name, attr in list(vars(cls).items()):
+        if inspect.isfunction(attr) and not name.startswith("__"):
+            setattr(cls, name, timed("db", name, attr))
+
+
+def instrument_app(app):
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint not in ("prometheus_metrics", "static"):
+            app.view_functions[endpoint] = timed("route", endpoint, view)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _summary(lines, metric, label, stats):
+    lines.append(f"# TYPE {metric} summary")
+    for name, s in sorted(stats.items()):
+        for q in (0.5, 0.99):
+            lines.append(f'{metric}{{{label}="{_label(name)}",quantile="{q}"}} {s.quantile(q):.9f}')
+        lines.append(f'{metric}_sum{{{label}="{_label(name)}"}} {s.total:.9f}')
+        lines.append(f'{metric}_count{{{label}="{_label(name)}"}} {s.count}')
+
+
+# prometheus text exposition of the timings, the session manager's counters and every resident
+# session's table sizes. sizes are read without the session locks, a scrape never waits on a turn
+def render(sessions):
+    lines = []
+    with registry.lock:
+        by_kind = {"db": {}, "route": {}}
+        for (kind, name), s in registry.stats.items():
+            copy = LatencyStats()
+            copy.count, copy.total, copy.buckets = s.count, s.total, list(s.buckets)
+            by_kind[kind][name] = copy
+    _summary(lines, "whack_db_method_seconds", "method", by_kind["db"])
+    _summary(lines, "whack_route_seconds", "route", by_kind["route"])
+
+    stats = sessions.stats()
+    lines.append("# TYPE whack_sessions gauge")
+    lines.append(f'whack_sessions{{state="resident"}} {stats["resident"]}')
+    lines.append(f'whack_sessions{{state="on_disk"}} {stats["on_disk"]}')
+    lines.append("# TYPE whack_sessions_resident_bytes gauge")
+    lines.append(f"whack_sessions_resident_bytes {stats['resident_bytes']}")
+    for counter in ("hits", "misses", "evictions"):
+        lines.append(f"# TYPE whack_session_cache_{counter}_total counter")
+        lines.append(f"whack_session_cache_{counter}_total {stats[counter]}")
+
+    sizes = {"transactions": [], "debts": [], "long_terms": [], "players": []}
+    for session, db in list(sessions.dbs.items()):
+        for table, n in db.table_sizes().items():
+            sizes[table].append((session, n))
+    for table, rows in sizes.items():
+        lines.append(f"# TYPE whack_session_{table} gauge")
+        for session, n in rows:
+            lines.append(f'whack_session_{table}{{session="{_label(session)}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+# samples every other thread's stack at a fixed interval and counts them in folded form,
+# one "outer;...;inner count" line per stack, the input flamegraph.pl and speedscope take
+class SamplingProfiler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = None
+        self.stacks = Counter()
+        self.samples = 0
+
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=0.005):
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self._run, args=(interval, self.stop_event), name="sampling-profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    # stops sampling and returns the folded stacks
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stop_event.set()
+            thread.join()
+        return self.folded()
+
+    def folded(self):
+        with self.lock:
+            return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def _run(self, interval, stop_event):
+        me = threading.get_ident()
+        while not stop_event.wait(interval):
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for ident, frame in frames.items():
+                    if ident != me:
+                        self.stacks[_fold(frame)] += 1
+
+
+def _fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+# vectorized version of Database.player_score, scores every player in one pass.
+# ids are small non-negative ints, so group-by sums are bincounts over the id space
+def batch_scores(
+    player_ids, player_turns,
+    tx_sender, tx_receiver, tx_payment, tx_turn, tx_from_score, tx_to_score,
+    debt_debtee, debt_start, debt_amount,
+    lt_receiver, lt_score,
+):
+    player_ids = np.asarray(player_ids, dtype=np.int64)
+    player_turns = np.asarray(player_turns, dtype=np.int64)
+    tx_sender = np.asarray(tx_sender, dtype=np.int64)
+    tx_receiver = np.asarray(tx_receiver, dtype=np.int64)
+    tx_payment = np.asarray(tx_payment, dtype=np.float64)
+    debt_debtee = np.asarray(debt_debtee, dtype=np.int64)
+    lt_receiver = np.asarray(lt_receiver, dtype=np.int64)
+
+    size = 1 + max(
+        [0] + [int(a.max()) for a in (player_ids, tx_sender, tx_receiver, debt_debtee, lt_receiver) if a.size]
+    )
+
+    # turns per id, so debts can look up their debtee's turn count
+    turns = np.zeros(size, dtype=np.int64)
+    turns[player_ids] = player_turns
+
+    # base scores of the transactions each player sent and received
+    sums = np.zeros(size, dtype=np.float64)
+    sums += np.bincount(tx_sender, weights=np.asarray(tx_from_score, dtype=np.float64), minlength=size)
+    sums += np.bincount(tx_receiver, weights=np.asarray(tx_to_score, dtype=np.float64), minlength=size)
+
+    # time decay, summed over every transaction in the session
+    payment_sum = tx_payment.sum()
+    payment_turn_sum = (tx_payment * np.asarray(tx_turn, dtype=np.int64)).sum()
+    sums += 0.0001 * (turns * payment_sum - payment_turn_sum)
+
+    # debts, truncated per debt like Debt.score_impact
+    elapsed = turns[debt_debtee] - np.asarray(debt_start, dtype=np.int64)
+    impacts = np.trunc(-elapsed * np.asarray(debt_amount, dtype=np.float64) * 0.0001)
+    sums += np.bincount(debt_debtee, weights=impacts, minlength=size)
+
+    # long terms
+    sums += np.bincount(lt_receiver, weights=np.asarray(lt_score, dtype=np.float64), minlength=size)
+
+    # same sigmoid as credit_score
+    bias = -4
+    sigmoid_num = 1 / (1 + np.exp(-(sums[player_ids] + bias)))
+    return sigmoid_num * 500 + 150
@@ -1,94 +1,158 @@
+import functools
+import hashlib
+import heapq
 import json
+import logging
 import math
+import os
+import secrets
+import threading
+from array import array
+from bisect import bisect_right
+from dataclasses import dataclass
+from weakref import WeakValueDictionary
+from itertools import batched, islice
 from flask import Flask
-from flask import request, jsonify
-
-
-# pure function
-def supermarket_buy_food(db, player_id):
-    supermarket = db.find_player_by_name(SUPER_MARKET_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 50
-    score = cost * 0.001
-    db.add_transaction(Transaction.new(db.id_gen, cost, player_id, supermarket.id, "buy food", current_turn, score, 0))
-
-
-def supermarket_part_time(db, player_id):
-    supermarket = db.find_player_by_name(SUPER_MARKET_NAME)
-    current_turn = db.get_player(player_id).turns
-    db.add_long_term(LongTerm.new(db.id_gen, player_id, supermarket.id, current_turn, current_turn + 5, "super market part time", 150, 0, 0, 0))
-
-
-# pure function
-def computer_shop_buy_computer(db, player_id):
-    computer_shop = db.find_player_by_name(COMPUTER_SHOP_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 200
-    score = cost * 0.001
-    db.add_transaction(Transaction.new(db.id_gen, cost, player_id, computer_shop.id, "buy computer", current_turn, score, 0))
-
-
-# pure function
-def rent(db, player_id):
-    accom = db.find_player_by_name(ACCOM_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 1000
-    score = cost * 0.004
-    db.add_transaction(Transaction.new(db.id_gen, cost, player_id, accom.id, "pay rent", current_turn, score, 0))
-
-
-def income_tax(db, player_id):
-    gov = db.find_player_by_name(GOV_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 200
-    score = 0
-    db.add_transaction(Transaction.new(db.id_gen, cost, player_id, gov.id, "pay income tax", current_turn, score, 0))
-
-
-def pay_utility_bill(db, player_id):
-    utility = db.find_player_by_name(UTILITY_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 50
-    score = cost * 0.001
-    db.add_transaction(Transaction.new(db.id_gen, cost, player_id, utility.id, "pay utility bill", current_turn, score, 0))
-
-
-def pay_medical_bill(db, player_id):
-    medical = db.find_player_by_name(HOSPITAL_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 100
-    score = 0
-    db.add_transaction(Transaction.new(db.id_gen, cost, player_id, medical.id, "pay medical bill", current_turn, score, 0))
-
-
-def get_netflex_subscription(db, player_id):
-    netflex = db.find_player_by_name(NETFLEX_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 20
-    db.add_long_term(LongTerm.new(db.id_gen, player_id, netflex.id, current_turn, current_turn + 5, "netflex subscription", -cost, 0, 0, 0))
-
-
-def scammed_20(db, player_id):
-    scammer = db.find_player_by_name(SCAMMER_NAME)
-    current_turn = db.get_player(player_id).turns
-    cost = 20
-    db.add_transaction(Transaction.new(db.id_gen, cost, player_id, scammer.id, "scammed", current_turn, 0, 0))
-
-
-FAKE_FUNCTION_POINTERS = {
-    "supermarket_buy_food": supermarket_buy_food,
-    "supermarket_part_time": supermarket_part_time,
-    "computer_shop_buy_computer": computer_shop_buy_computer,
-    "rent": rent,
-    "income_tax": income_tax,
-    "pay_utility_bill": pay_utility_bill,
-    "pay_medical_bill": pay_medical_bill,
-    "get_netflex_subscription": get_netflex_subscription,
-    "scammed_20": scammed_20,
-    "do_nothing": lambda db, player_id: None,
+from flask import request, jsonify, Response
+
+import serializer
+from events import EventHub
+from journal import JournalStore, journaled
+import logs
+import metrics
+from scoring import batch_scores
+from sessions import SessionManager
+
+log = logs.get_logger("server")
+
+
+# the economy, read at call time so simulate.py can tune it with --set NAME=value
+FOOD_COST = 50
+PART_TIME_PAY = 150  # per round, for CONTRACT_TURNS turns
+COMPUTER_COST = 200
+RENT_COST = 1000
+INCOME_TAX = 200
+UTILITY_BILL = 50
+MEDICAL_BILL = 100
+NETFLEX_COST = 20  # per round, for CONTRACT_TURNS turns
+SCAM_COST = 20
+CONTRACT_TURNS = 5  # length of part time jobs and subscriptions
+DEBT_INTEREST_RATE = 0.05  # added to every debt each round
+SAVINGS_INTEREST_RATE = 0.01  # paid on a new player's money each round
+ROUND_TURNS = 4  # interest, debts and long terms are processed every ROUND_TURNS turns
+
+# the constants above, the only names an ActionSpec amount or duration may give
+ECONOMY = (
+    "FOOD_COST", "PART_TIME_PAY", "COMPUTER_COST", "RENT_COST", "INCOME_TAX", "UTILITY_BILL", "MEDICAL_BILL",
+    "NETFLEX_COST", "SCAM_COST", "CONTRACT_TURNS", "DEBT_INTEREST_RATE", "SAVINGS_INTEREST_RATE", "ROUND_TURNS",
+)
+
+
+BANK_NAME = "__Bank"
+SUPER_MARKET_NAME = "__Super Market"
+COMPUTER_SHOP_NAME = "__Computer Shop"
+GOV_NAME = "__Government"
+UTILITY_NAME = "__Utility Company"
+HOSPITAL_NAME = "__Medical Company"
+HOUSING_NAME = "__Housing Company"
+ACCOM_NAME = "__Accomodation"
+NETFLEX_NAME = "__NETFLEX"
+SCAMMER_NAME = "__Scammer"
+
+# every game starts with these NPCs in this order, new_game adds them first so their ids are fixed
+NPC_NAMES = (
+    BANK_NAME, SUPER_MARKET_NAME, COMPUTER_SHOP_NAME, GOV_NAME, UTILITY_NAME,
+    HOSPITAL_NAME, HOUSING_NAME, ACCOM_NAME, NETFLEX_NAME, SCAMMER_NAME,
+)
+(
+    BANK_ID, SUPER_MARKET_ID, COMPUTER_SHOP_ID, GOV_ID, UTILITY_ID,
+    HOSPITAL_ID, HOUSING_ID, ACCOM_ID, NETFLEX_ID, SCAMMER_ID,
+) = range(len(NPC_NAMES))
+
+
+# an action a location offers, as data. a "payment" sends the amount from the player to the counterparty
+# once, the player's score moves by amount * score_factor. a "long_term" starts a contract of duration turns
+# with the counterparty paying the player sign * amount each round. "none" changes nothing.
+# amount and duration name economy constants, read when the action runs so simulate.py --set applies to them
+@dataclass(slots=True, frozen=True)
+class ActionSpec:
+    kind: str
+    counterparty: int | None = None
+    amount: str | None = None
+    desc: str = ""
+    score_factor: float = 0.0
+    sign: int = 1
+    duration: str = "CONTRACT_TURNS"
+
+
+# new actions only need a row here and a location offering them
+ACTIONS = {
+    "supermarket_buy_food": ActionSpec("payment", SUPER_MARKET_ID, "FOOD_COST", "buy food", 0.001),
+    "supermarket_part_time": ActionSpec("long_term", SUPER_MARKET_ID, "PART_TIME_PAY", "super market part time"),
+    "computer_shop_buy_computer": ActionSpec("payment", COMPUTER_SHOP_ID, "COMPUTER_COST", "buy computer", 0.001),
+    "rent": ActionSpec("payment", ACCOM_ID, "RENT_COST", "pay rent", 0.004),
+    "income_tax": ActionSpec("payment", GOV_ID, "INCOME_TAX", "pay income tax"),
+    "pay_utility_bill": ActionSpec("payment", UTILITY_ID, "UTILITY_BILL", "pay utility bill", 0.001),
+    "pay_medical_bill": ActionSpec("payment", HOSPITAL_ID, "MEDICAL_BILL", "pay medical bill"),
+    "get_netflex_subscription": ActionSpec("long_term", NETFLEX_ID, "NETFLEX_COST", "netflex subscription", sign=-1),
+    "scammed_20": ActionSpec("payment", SCAMMER_ID, "SCAM_COST", "scammed"),
+    "do_nothing": ActionSpec("none"),
+    # a prompt, the client asks the player and runs scammed_20 when they fall for it
+    "scam_event": ActionSpec("none"),
 }
 
 
+# the (db, player_id) function that runs an action, with everything but the amount bound up front
+def compile_action(name, spec):
+    economy = globals()
+    if spec.kind == "none":
+        return lambda db, player_id: None
+    amount_ok = spec.amount in ECONOMY and type(economy[spec.amount]) in (int, float)
+    if spec.counterparty not in range(len(NPC_NAMES)) or not amount_ok:
+        raise ValueError(f"action {name}: bad counterparty {spec.counterparty} or amount {spec.amount}")
+    counterparty, amount, desc, score_factor, sign = spec.counterparty, spec.amount, spec.desc, spec.score_factor, spec.sign
+    duration = spec.duration
+
+    if spec.kind == "payment":
+        def run(db, player_id):
+            cost = economy[amount]
+            turn = db.get_player(player_id).turns
+            db.add_transaction(Transaction.new(db.id_gen, cost, player_id, counterparty, desc, turn, cost * score_factor, 0))
+    elif spec.kind == "long_term":
+        if duration not in ECONOMY or type(economy[duration]) is not int:
+            raise ValueError(f"action {name}: bad duration {duration}")
+
+        def run(db, player_id):
+            turn = db.get_player(player_id).turns
+            db.add_long_term(LongTerm.new(db.id_gen, player_id, counterparty, turn, turn + economy[duration], desc, sign * economy[amount], 0, 0, 0))
+    else:
+        raise ValueError(f"action {name}: unknown kind {spec.kind}")
+    run.__name__ = name
+    return run
+
+
+ACTION_HANDLERS = {name: compile_action(name, spec) for name, spec in ACTIONS.items()}
+
+
+# an error message, or None when the action can run for the player
+def validate_action(db, action, player_id):
+    if action not in ACTION_HANDLERS:
+        return f"unknown action {action}"
+    if db.get_player(player_id) is None:
+        return f"no player {player_id}"
+    return None
+
+
+# an error message, or None when every id is a player of the session
+def validate_players(db, player_ids):
+    if not isinstance(player_ids, list):
+        return "player_ids must be a list"
+    for player_id in player_ids:
+        if not _is_int(player_id) or db.get_player(player_id) is None:
+            return f"no player {player_id}"
+    return None
+
+
 # id generator, can be replaced with supabase id gen if any
 class IDGenerator:
 
@@ -96,10 +160,50 @@ class IDGenerator:
         self.player_id_generator = 0
         self.transaction_id_generator = 0
         self.debt_id_generator = 0
-
-
-# pure player data, can be stored as record on supabase
+        self.lock = threading.Lock()
+
+    # each counter is read and bumped under the lock, so threads never share an id
+    def next_player_id(self):
+        with self.lock:
+            id = self.player_id_generator
+            self.player_id_generator += 1
+        return id
+
+    def next_transaction_id(self):
+        with self.lock:
+            id = self.transaction_id_generator
+            self.transaction_id_generator += 1
+        return id
+
+    def next_debt_id(self):
+        with self.lock:
+            id = self.debt_id_generator
+            self.debt_id_generator += 1
+        return id
+
+    def counters(self):
+        return self.player_id_generator, self.transaction_id_generator, self.debt_id_generator
+
+    # locks do not pickle
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+# pure player data, can be stored as record on supabase.
+# the model classes are slotted dataclasses, fields are declared in json key order
+@dataclass(slots=True, init=False, eq=False)
 class Player:
+    name: str
+    location_idx: int
+    interest_rate: float
+    turns: int
+    id: int
 
     def __init__(self, id, name, location_idx, interest_rate, turns):
         self.name = name
@@ -110,24 +214,41 @@ class Player:
 
     def new(id_gen, name):
         location_idx = 0
-        interest_rate = 0.01
+        interest_rate = SAVINGS_INTEREST_RATE
         turns = 0
 
         # id generation
-        id = id_gen.player_id_generator
-        id_gen.player_id_generator += 1
+        id = id_gen.next_player_id()
 
         return Player(id, name, location_idx, interest_rate, turns)
 
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "location_idx": self.location_idx,
+            "interest_rate": self.interest_rate,
+            "turns": self.turns,
+            "id": self.id,
+        }
+
     def json_encode(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def json_decode(obj):
         return Player(**obj)
 
 
 # pure transaction data, can be stored on supabase
+@dataclass(slots=True, init=False, eq=False)
 class Transaction:
+    payment: float
+    sender_id: int
+    reciever_id: int
+    desc: str
+    turn: int
+    base_from_score: float
+    base_to_score: float
+    id: int
 
     def __init__(self, id, payment, sender_id, reciever_id, desc, turn, base_from_score, base_to_score):
         self.payment = payment
@@ -143,13 +264,24 @@ class Transaction:
     def new(id_gen, payment, sender_id, reciever_id, desc, turn, base_from_score, base_to_score):
 
         # id generation
-        id = id_gen.transaction_id_generator
-        id_gen.transaction_id_generator += 1
+        id = id_gen.next_transaction_id()
 
         return Transaction(id, payment, sender_id, reciever_id, desc, turn, base_from_score, base_to_score)
 
+    def to_dict(self):
+        return {
+            "payment": self.payment,
+            "sender_id": self.sender_id,
+            "reciever_id": self.reciever_id,
+            "desc": self.desc,
+            "turn": self.turn,
+            "base_from_score": self.base_from_score,
+            "base_to_score": self.base_to_score,
+            "id": self.id,
+        }
+
     def json_encode(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def json_decode(obj):
         return Transaction(**obj)
@@ -159,36 +291,199 @@ class Transaction:
         return f"transaction: payment: {self.payment} from: {self.sender_id} to: {self.reciever_id} desc: {self.desc} turn: {self.turn} base_from_score: {self.base_from_score} base_to_score: {self.base_to_score}"
 
 
+# payments and scores are stored as doubles, whole numbers come back as ints
+def _number(x):
+    return int(x) if x.is_integer() else x
+
+
+# append-only columnar transaction log, one typed array per field.
+# descriptions are interned in a table, indexing hands out Transaction views
+class TransactionStore:
+
+    def __init__(self):
+        self.ids = array("q")
+        self.payments = array("d")
+        self.sender_ids = array("i")
+        self.reciever_ids = array("i")
+        self.turns = array("i")
+        self.from_scores = array("d")
+        self.to_scores = array("d")
+        self.desc_idx = array("i")
+        self.descs = []  # desc index -> desc
+        self.desc_table = {}  # desc -> desc index
+        self.rows_by_player = {}  # player id -> rows the player sent or received
+
+    def append(self, t):
+        row = len(self.ids)
+        desc_idx = self.desc_table.get(t.desc)
+        if desc_idx is None:
+            desc_idx = self.desc_table[t.desc] = len(self.descs)
+            self.descs.append(t.desc)
+
+        # a value the column's typecode rejects takes back the row's earlier columns, so the columns
+        # always stay the same length
+        try:
+            self.ids.append(t.id)
+            self.payments.append(t.payment)
+            self.sender_ids.append(t.sender_id)
+            self.reciever_ids.append(t.reciever_id)
+            self.turns.append(int(t.turn))
+            self.from_scores.append(t.base_from_score)
+            self.to_scores.append(t.base_to_score)
+            self.desc_idx.append(desc_idx)
+        except Exception:
+            for column in self.columns():
+                del column[row:]
+            raise
+
+        self.rows_by_player.setdefault(t.sender_id, array("i")).append(row)
+        if t.reciever_id != t.sender_id:
+            self.rows_by_player.setdefault(t.reciever_id, array("i")).append(row)
+
+    def columns(self):
+        return (self.ids, self.payments, self.sender_ids, self.reciever_ids, self.turns, self.from_scores, self.to_scores, self.desc_idx)
+
+    def view(self, row):
+        return Transaction(
+            self.ids[row],
+            _number(self.payments[row]),
+            self.sender_ids[row],
+            self.reciever_ids[row],
+            self.descs[self.desc_idx[row]],
+            self.turns[row],
+            _number(self.from_scores[row]),
+            _number(self.to_scores[row]),
+        )
+
+    def player_rows(self, player_id):
+        return self.rows_by_player.get(player_id, ())
+
+    # rows in id order after the cursor id, ids only grow as rows are appended.
+    # counterparty alone selects every transaction it took part in
+    # the bounds are fixed when select is called, so the rows can be read after the
+    # session lock is released while later transactions are appended
+    def select(self, after_id=None, turn_from=None, turn_to=None, player_id=None, counterparty=None):
+        if player_id is None and counterparty is not None:
+            player_id, counterparty = counterparty, None
+        if player_id is None:
+            rows = range(len(self.ids))
+            start = 0 if after_id is None else bisect_right(self.ids, after_id)
+        else:
+            rows = self.player_rows(player_id)
+            start = 0 if after_id is None else bisect_right(rows, after_id, key=self.ids.__getitem__)
+        return self._filter_rows(rows, start, len(rows), turn_from, turn_to, player_id, counterparty)
+
+    def _filter_rows(self, rows, start, end, turn_from, turn_to, player_id, counterparty):
+        for i in range(start, end):
+            row = rows[i]
+            turn = self.turns[row]
+            if turn_from is not None and turn < turn_from:
+                continue
+            if turn_to is not None and turn > turn_to:
+                continue
+            if counterparty is not None:
+                other = self.reciever_ids[row] if self.sender_ids[row] == player_id else self.sender_ids[row]
+                if other != counterparty:
+                    continue
+            yield row
+
+    def __len__(self):
+        return len(self.ids)
+
+    # bytes held by the columns and the per-player row index
+    def nbytes(self):
+        return sum(c.itemsize * len(c) for c in self.columns()) + sum(r.itemsize * len(r) for r in self.rows_by_player.values())
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self.view(i) for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        return self.view(row)
+
+    def __iter__(self):
+        for row in range(len(self.ids)):
+            yield self.view(row)
+
+
 # pure string data, can be stored on supabase
+@dataclass(slots=True, init=False, eq=False)
 class Action:
+    desc: str
+    func: str
 
     def __init__(self, desc, func):
         self.desc = desc
         self.func = func
 
+    def to_dict(self):
+        return {"desc": self.desc, "func": self.func}
+
     def json_encode(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def json_decode(obj):
         return Action(**obj)
 
 
 # pure data, can be stored on supabase
+@dataclass(slots=True, init=False, eq=False)
 class Location:
+    idx: int
+    name: str
+    actions: list[Action]
 
     def __init__(self, idx, name, actions):
         self.idx = idx
         self.name = name
         self.actions = actions
 
+    def to_dict(self):
+        return {"idx": self.idx, "name": self.name, "actions": [a.to_dict() for a in self.actions]}
+
     def json_encode(self):
-        return json.dumps(self.__dict__, default=lambda o: o.__dict__)
+        return json.dumps(self.to_dict())
 
     def json_decode(obj):
         return Location(obj["idx"], obj["name"], [Action.json_decode(a) for a in obj["actions"]])
 
 
+# a board's locations encoded once, shared by every session whose board encodes the same.
+# moves and get_location send these bytes as they are, /<session>/board sends the whole board
+class BoardPayloads:
+    __slots__ = ("locations", "board", "etag", "__weakref__")
+
+    def __init__(self, locations, board):
+        self.locations = locations  # encoded location per board index
+        self.board = board
+        self.etag = hashlib.blake2b(board, digest_size=12).hexdigest()
+
+
+_boards = WeakValueDictionary()  # encoded board -> BoardPayloads
+
+
+def board_payloads(locations):
+    encoded = [serializer.dumps(location) for location in locations]
+    board = b"[" + b",".join(encoded) + b"]"
+    payloads = _boards.get(board)
+    if payloads is None:
+        payloads = _boards[board] = BoardPayloads(encoded, board)
+    return payloads
+
+
+@dataclass(slots=True, init=False, eq=False)
 class LongTerm:
+    amount: int
+    start_turn: int
+    end_turn: int
+    desc: str
+    receiver_id: int
+    sender_id: int
+    interest_rate: float
+    sender_score: float
+    receiver_score: float
+    id: int
+
     def __init__(self, id, receiver_id, sender_id, start_turn, end_turn, desc, amount, interest_rate, sender_score, receiver_score):
         self.amount = amount
         self.start_turn = start_turn
@@ -202,13 +497,26 @@ class LongTerm:
         self.id = id
 
     def new(id_gen, receiver_id, sender_id, start_turn, end_turn, desc, amount, interest_rate, sender_score, receiver_score):
-        id = id_gen.debt_id_generator
-        id_gen.debt_id_generator += 1
+        id = id_gen.next_debt_id()
 
         return LongTerm(id, receiver_id, sender_id, start_turn, end_turn, desc, amount, interest_rate, sender_score, receiver_score)
 
+    def to_dict(self):
+        return {
+            "amount": self.amount,
+            "start_turn": self.start_turn,
+            "end_turn": self.end_turn,
+            "desc": self.desc,
+            "receiver_id": self.receiver_id,
+            "sender_id": self.sender_id,
+            "interest_rate": self.interest_rate,
+            "sender_score": self.sender_score,
+            "receiver_score": self.receiver_score,
+            "id": self.id,
+        }
+
     def json_encode(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def json_decode(obj):
         return LongTerm(**obj)
@@ -222,8 +530,15 @@ class LongTerm:
 
 
 # pure debt data, can be stored on supabase
+@dataclass(slots=True, init=False, eq=False)
 class Debt:
-    
+    amount: int
+    start_turn: int
+    debtee_id: int
+    loaner_id: int
+    interest_rate: float
+    id: int
+
     def __init__(self, id, debtee_id, start_turn, amount, interest_rate, loaner_id):
         self.amount = amount
         self.start_turn = start_turn
@@ -233,13 +548,22 @@ class Debt:
         self.id = id
 
     def new(state, debtee_id, start_turn, amount, interest_rate, loaner_id):
-        id = state.debt_id_generator
-        state.debt_id_generator += 1
+        id = state.next_debt_id()
 
         return Debt(id, debtee_id, start_turn, amount, interest_rate, loaner_id)
 
+    def to_dict(self):
+        return {
+            "amount": self.amount,
+            "start_turn": self.start_turn,
+            "debtee_id": self.debtee_id,
+            "loaner_id": self.loaner_id,
+            "interest_rate": self.interest_rate,
+            "id": self.id,
+        }
+
     def json_encode(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def json_decode(obj):
         return Debt(**obj)
@@ -259,91 +583,291 @@ class Debt:
         self.amount -= amount
 
 
+# running credit score aggregates, so player_score does not rescan the log.
+# the time decay term 0.0001 * (turns - t.turn) * t.payment is summed over every
+# transaction in the session, so it splits into turns * Σpayment - Σ(payment * turn)
+class ScoreAccumulator:
+
+    def __init__(self):
+        self.payment_sum = 0
+        self.payment_turn_sum = 0
+        self.base_scores = {}  # player id -> Σ base scores of their transactions
+        self.long_term_scores = {}  # player id -> Σ receiver scores of their long terms
+        self.debt_impacts = {}  # player id -> (turns, Σ debt score impacts at that turn)
+
+    def add_transaction(self, t):
+        self.payment_sum += t.payment
+        self.payment_turn_sum += t.payment * int(t.turn)
+        self.base_scores[t.sender_id] = self.base_scores.get(t.sender_id, 0) + t.base_from_score
+        self.base_scores[t.reciever_id] = self.base_scores.get(t.reciever_id, 0) + t.base_to_score
+
+    def add_long_term(self, l):
+        self.long_term_scores[l.receiver_id] = self.long_term_scores.get(l.receiver_id, 0) + l.receiver_score
+
+    def remove_long_term(self, l):
+        self.long_term_scores[l.receiver_id] -= l.receiver_score
+
+    # debt impacts are truncated per debt, so they are cached per turn rather than summed
+    def debts_changed(self, player_id):
+        self.debt_impacts.pop(player_id, None)
+
+    def transaction_sum(self, player_id, turns):
+        decay = 0.0001 * (turns * self.payment_sum - self.payment_turn_sum)
+        return self.base_scores.get(player_id, 0) + decay
+
+
+def credit_score(sum):
+    bias = -4
+    sum += bias
+    sigmoid_num = 1 / (1 + math.exp(-sum))
+    return sigmoid_num * 500 + 150
+
+
 # the current database, also contains a mess of logics
 class Database:
     def __init__(self, id_gen, size):
         self.id_gen = id_gen
-        self.transactions = []
+        self.transactions = TransactionStore()
         self.players = []
         self.locations = [
             Location(i, "Empty", []) for i in range(size)
         ]
+        self.locations_shared = False  # the locations list belongs to a BoardTemplate, copied on first change
+        self.board = None  # BoardPayloads for the locations, built on first use
         self.debts = []
-        self.long_terms = []
+        self.long_terms = {}  # id -> long term, in the order they were added, so retiring one is a delete
+        self.balances = {}  # player id -> running money, kept in step with transactions
+        self.scores = ScoreAccumulator()
+
+        # change tracking for delta sync, every mutation bumps the session version. versions start again
+        # with every game, clients hold "<epoch>-<version>" cursors so a new game is told from an old one
+        self.epoch = secrets.randbits(32)
+        self.version = 0
+        self.changed = {"players": {}, "debts": {}, "long_terms": {}}  # kind -> id -> version last changed
+        self.removed_long_terms = {}  # long term id -> version removed
+        self.transaction_versions = array("q")  # version each transaction row was added at
+
+        # lookup indexes, kept in step with the lists above
+        self.players_by_id = {}
+        self.players_by_name = {}
+        self.debts_by_id = {}
+        self.debts_by_player = {}  # debtee id -> debts
+        self.long_terms_by_player = {}  # receiver id -> id -> long term
+
+        # player id -> heap of (due turn, id, debt or long term), what four_turner has to process.
+        # debts and long terms share an id generator, so entries never tie past the id
+        self.due = {}
+
+        # set by the JournalStore when the session is durable, see journal.py
+        self.journal = None
+        self.journal_depth = 0
+
+    # rough resident size, for the session store's memory budget. measured with tracemalloc, a new game
+    # is about 6 kB and each player, debt or long term about 250 B on top of the transaction columns
+    def estimated_bytes(self):
+        objects = len(self.players) + len(self.debts) + len(self.long_terms)
+        versions = self.transaction_versions.itemsize * len(self.transaction_versions)
+        return 6000 + 250 * objects + self.transactions.nbytes() + versions
+
+    # row counts for /metrics, which reads them without the session lock
+    def table_sizes(self):
+        return {
+            "transactions": self.transaction_count(),
+            "debts": len(self.debts),
+            "long_terms": len(self.long_terms),
+            "players": len(self.players),
+        }
+
+    def transaction_count(self):
+        return len(self.transactions)
+
+    # the journal belongs to the process, snapshots and migrated sessions leave it behind
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["journal"] = None
+        state["board"] = None
+        return state
+
+    # sessions pickled before the due queues get them built from the lists, their long term list keyed
+    # by id and an epoch of their own
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "epoch" not in state:
+            self.epoch = secrets.randbits(32)
+        if isinstance(self.long_terms, list):
+            self.long_terms = {long_term.id: long_term for long_term in self.long_terms}
+            self.__dict__.pop("long_terms_by_id", None)
+            self.long_terms_by_player = {}
+            for long_term in self.long_terms.values():
+                self.index_long_term(long_term)
+        if "due" not in state:
+            self.rebuild_due()
 
     # can be endpoint, but used only in game init
+    @journaled
     def set_location(self, idx, location):
+        if self.locations_shared:
+            self.locations = list(self.locations)
+            self.locations_shared = False
         self.locations[idx] = location
+        self.board = None
+
+    # starts the session on the template's board, shared until set_location changes it
+    def share_board(self, template):
+        self.locations = template.locations
+        self.locations_shared = True
+        self.board = template.payloads
+
+    # the encoded board, locations must only be changed through set_location to keep it current
+    def board_payloads(self):
+        if self.board is None:
+            self.board = board_payloads(self.locations)
+        return self.board
 
     # can be endpoint
     def get_location(self, idx):
         return self.locations[idx]
 
     # can be endpoint
+    @journaled
     def run_action(self, action, player_id):
-        FAKE_FUNCTION_POINTERS[action](self, player_id)
+        ACTION_HANDLERS[action](self, player_id)
+
+    # can be endpoint, the action for each player in turn, journaled as one record
+    @journaled
+    def run_action_many(self, action, player_ids):
+        run = ACTION_HANDLERS[action]
+        for player_id in player_ids:
+            run(self, player_id)
 
     # can be endpoint
+    @journaled
     def add_player(self, player):
         self.players.append(player)
+        self.index_player(player)
+        self.touch("players", player.id)
+
+    # can be endpoint. the new_* methods draw the object's id inside the journaled call, so replaying
+    # the record draws it again and the id counters come back in step
+    @journaled
+    def new_player(self, name):
+        player = Player.new(self.id_gen, name)
+        self.add_player(player)
+        return player
+
+    # first player added with a given id or name wins, same as the old list scan
+    def index_player(self, player):
+        self.players_by_id.setdefault(player.id, player)
+        self.players_by_name.setdefault(player.name, player)
 
     # can be endpoint
     def find_player_by_name(self, name):
-        for player in self.players:
-            if player.name == name:
-                return player
-        return None
+        return self.players_by_name.get(name)
 
     # can be endpoint
     def get_player(self, id) -> Player | None:
-        for player in self.players:
-            if player.id == id:
-                return player
-        return None
+        return self.players_by_id.get(id)
 
     # can be endpoint
+    @journaled
     def add_debt(self, debt):
         self.debts.append(debt)
+        self.index_debt(debt)
+        self.schedule(debt.debtee_id, debt)
+        self.scores.debts_changed(debt.debtee_id)
+        self.touch("debts", debt.id)
+
+    # can be endpoint
+    @journaled
+    def new_debt(self, debtee_id, start_turn, amount, interest_rate, loaner_id):
+        debt = Debt.new(self.id_gen, debtee_id, start_turn, amount, interest_rate, loaner_id)
+        self.add_debt(debt)
+        return debt
+
+    def index_debt(self, debt):
+        self.debts_by_id.setdefault(debt.id, debt)
+        self.debts_by_player.setdefault(debt.debtee_id, []).append(debt)
 
     # can be endpoint
     def get_debt(self, id):
-        for debt in self.debts:
-            if debt.id == id:
-                return debt
-        return None
+        return self.debts_by_id.get(id)
 
     # can be endpoint
     def get_player_debts(self, player_id):
-        return [d for d in self.debts if d.debtee_id == player_id]
+        return list(self.debts_by_player.get(player_id, ()))
 
+    @journaled
     def add_long_term(self, long_term):
-        self.long_terms.append(long_term)
+        self.long_terms[long_term.id] = long_term
+        self.index_long_term(long_term)
+        self.schedule(long_term.receiver_id, long_term)
+        self.scores.add_long_term(long_term)
+        self.touch("long_terms", long_term.id)
+
+    def index_long_term(self, long_term):
+        self.long_terms_by_player.setdefault(long_term.receiver_id, {})[long_term.id] = long_term
+
+    def remove_long_term(self, long_term):
+        del self.long_terms[long_term.id]
+        del self.long_terms_by_player[long_term.receiver_id][long_term.id]
+        self.scores.remove_long_term(long_term)
+        self.touch("long_terms", long_term.id)
+        self.removed_long_terms[long_term.id] = self.version
 
     def get_long_term(self, id):
-        for long_term in self.long_terms:
-            if long_term.id == id:
-                return long_term
-        return None
+        return self.long_terms.get(id)
 
     def get_player_long_terms(self, player_id):
-        return [d for d in self.long_terms if d.receiver_id == player_id]
+        return list(self.long_terms_by_player.get(player_id, {}).values())
+
+    # rebuild every lookup index from the lists
+    def rebuild_indexes(self):
+        self.players_by_id = {}
+        self.players_by_name = {}
+        self.debts_by_id = {}
+        self.debts_by_player = {}
+        self.long_terms_by_player = {}
+        for player in self.players:
+            self.index_player(player)
+        for debt in self.debts:
+            self.index_debt(debt)
+        for long_term in self.long_terms.values():
+            self.index_long_term(long_term)
+
+    # queues a debt or long term for the player's first round after turn, their current turn by default
+    def schedule(self, player_id, item, turn=None):
+        if turn is None:
+            player = self.get_player(player_id)
+            turn = player.turns if player is not None else 0
+        heapq.heappush(self.due.setdefault(player_id, []), ((turn // ROUND_TURNS + 1) * ROUND_TURNS, item.id, item))
+
+    # rebuild the due queues from the lists, repaid debts have nothing left to process
+    def rebuild_due(self):
+        self.due = {}
+        for debt in self.debts:
+            if debt.amount != 0:
+                self.schedule(debt.debtee_id, debt)
+        for long_term in self.long_terms.values():
+            self.schedule(long_term.receiver_id, long_term)
 
     # can be endpoint
+    @journaled
     def borrow_debt(self, player_id, amount):
-        bank = self.find_player_by_name(BANK_NAME)
         current_turn = self.get_player(player_id).turns
         score = amount * 0.001
-        self.add_debt(Debt.new(self.id_gen, player_id, current_turn, amount, 0.05, bank.id))
-        self.add_transaction(Transaction.new(self.id_gen, amount, bank.id, player_id, "borrow", current_turn, 0, -score))
+        self.add_debt(Debt.new(self.id_gen, player_id, current_turn, amount, DEBT_INTEREST_RATE, BANK_ID))
+        self.add_transaction(Transaction.new(self.id_gen, amount, BANK_ID, player_id, "borrow", current_turn, 0, -score))
 
     # can be endpoint
+    @journaled
     def repay_debt(self, debt_id, debtee_id, amount):
-        bank = self.find_player_by_name(BANK_NAME)
         debt = self.get_debt(debt_id)
         current_turn = self.get_player(debtee_id).turns
         score = amount * 0.001
-        self.add_transaction(Transaction.new(self.id_gen, amount, debtee_id, bank.id, "repay debt", current_turn, 0, score))
+        self.add_transaction(Transaction.new(self.id_gen, amount, debtee_id, BANK_ID, "repay debt", current_turn, 0, score))
         debt.repay(amount)
+        self.scores.debts_changed(debt.debtee_id)
+        self.touch("debts", debt.id)
 
     # can be endpoint
     def move_player_rel(self, db, player, rel):
@@ -351,24 +875,165 @@ class Database:
         return self.move_player_abs(db, player.id, location_idx)
 
     # can be endpoint
+    @journaled
     def move_player_abs(self, db, player_id, location_idx):
         player = db.get_player(player_id)
         player.location_idx = location_idx
+        self.touch("players", player.id)
 
         location = self.locations[location_idx]
         return location
 
+    # can be endpoint, fields are Transaction.new's keyword arguments
+    @journaled
+    def new_transaction(self, fields):
+        transaction = Transaction.new(self.id_gen, **fields)
+        self.add_transaction(transaction)
+        return transaction
+
     # can be endpoint
+    @journaled
     def add_transaction(self, transaction):
         self.transactions.append(transaction)
+        self.apply_balance(transaction)
+        self.scores.add_transaction(transaction)
+
+        # both sides' money changed
+        self.version += 1
+        self.transaction_versions.append(self.version)
+        self.changed["players"][transaction.sender_id] = self.version
+        self.changed["players"][transaction.reciever_id] = self.version
+
+    # changes whenever the session or its id counters do, the journal compares it around a failed call
+    def change_mark(self):
+        return self.version, self.id_gen.counters()
+
+    # bumps the session version and records it against the changed object
+    def touch(self, kind, id):
+        self.version += 1
+        self.changed[kind][id] = self.version
+
+    # the client's cursor for the session as it is now
+    def cursor(self):
+        return f"{self.epoch}-{self.version}"
+
+    # the version a cursor points at, 0 when it is from another game of the session or not a cursor
+    def since_version(self, cursor):
+        epoch, _, version = str(cursor).partition("-")
+        if epoch != str(self.epoch) or not version.isdigit():
+            return 0
+        return int(version)
+
+    # can be endpoint, everything that changed after the given cursor
+    def changes(self, cursor):
+        return self.changes_since(self.since_version(cursor))
+
+    def changes_since(self, since):
+        # a version from the future means the client is out of step, send everything
+        if since > self.version:
+            since = 0
+
+        def changed_since(kind):
+            return [id for id, version in self.changed[kind].items() if version > since]
+
+        players = [p for p in map(self.get_player, changed_since("players")) if p is not None]
+        return {
+            "version": self.cursor(),
+            "players": players,
+            "money": [{"id": p.id, "money": self.player_money(p.id)} for p in players],
+            "transactions": self.transactions_since(since),
+            "debts": [self.get_debt(id) for id in changed_since("debts")],
+            "long_terms": [l for l in map(self.get_long_term, changed_since("long_terms")) if l is not None],
+            "removed_long_terms": [id for id, version in self.removed_long_terms.items() if version > since],
+        }
+
+    # transactions added after the given version, in id order
+    def transactions_since(self, since):
+        return self.transactions[bisect_right(self.transaction_versions, since):]
+
+    # writes made since the last commit are durable after this. the in-memory database has nothing to do,
+    # storage backends flush their batched writes here. the session manager commits after every write
+    def commit(self):
+        pass
+
+    # ledger update for a single transaction, O(1)
+    def apply_balance(self, transaction):
+        balances = self.balances
+        balances[transaction.sender_id] = balances.get(transaction.sender_id, STARTING_MONEY) - transaction.payment
+        balances[transaction.reciever_id] = balances.get(transaction.reciever_id, STARTING_MONEY) + transaction.payment
+
+    # rebuild the ledger from the transaction log
+    def rebuild_balances(self):
+        self.balances = {}
+        for t in self.transactions:
+            self.apply_balance(t)
 
     # can be endpoint
     def get_transactions(self):
         return self.transactions
 
+    # can be endpoint, a page of transactions after the cursor id, pass the last id back to continue
+    def query_transactions(self, after_id=None, limit=None, turn_from=None, turn_to=None, player_id=None, counterparty=None):
+        rows = self.transactions.select(after_id, turn_from, turn_to, player_id, counterparty)
+        return [self.transactions.view(row) for row in islice(rows, limit)]
+
+    # the same selection in chunks, for streamed exports
+    def transaction_chunks(self, size, after_id=None, turn_from=None, turn_to=None, player_id=None, counterparty=None):
+        rows = self.transactions.select(after_id, turn_from, turn_to, player_id, counterparty)
+        return ([self.transactions.view(row) for row in chunk] for chunk in batched(rows, size))
+
+    # rebuild the score aggregates from the transaction log and long terms
+    def rebuild_scores(self):
+        self.scores = ScoreAccumulator()
+        for t in self.transactions:
+            self.scores.add_transaction(t)
+        for l in self.long_terms.values():
+            self.scores.add_long_term(l)
+
     # can be endpoint
     def player_score(self, id):
+        turns = self.get_player(id).turns
+        sum = self.scores.transaction_sum(id, turns)
+        sum += self.debt_score(id, turns)
+        sum += self.scores.long_term_scores.get(id, 0)
+        return credit_score(sum)
+
+    # can be endpoint, scores every player of the session in one vectorized pass
+    def all_player_scores(self):
+        players = self.players
+        transactions = self.transactions
+        scores = batch_scores(
+            [p.id for p in players],
+            [p.turns for p in players],
+            transactions.sender_ids,
+            transactions.reciever_ids,
+            transactions.payments,
+            transactions.turns,
+            transactions.from_scores,
+            transactions.to_scores,
+            [d.debtee_id for d in self.debts],
+            [d.start_turn for d in self.debts],
+            [d.amount for d in self.debts],
+            [l.receiver_id for l in self.long_terms.values()],
+            [l.receiver_score for l in self.long_terms.values()],
+        )
+        return {p.id: float(score) for p, score in zip(players, scores)}
+
+    def debt_score(self, player_id, turns):
+        cached = self.scores.debt_impacts.get(player_id)
+        if cached is not None and cached[0] == turns:
+            return cached[1]
+        impact = 0
+        for d in self.debts_by_player.get(player_id, ()):
+            impact += d.score_impact(self)
+        self.scores.debt_impacts[player_id] = (turns, impact)
+        return impact
+
+    # full scan, reference for the score aggregates. every step is logged at debug level
+    def scan_player_score(self, id):
+        debug = log.isEnabledFor(logging.DEBUG)
         sum = 0  # initial credit score
+        turns = self.get_player(id).turns
         # transactions
         for t in self.transactions:
             if t.sender_id == id:
@@ -376,29 +1041,42 @@ class Database:
             if t.reciever_id == id:
                 sum += t.base_to_score
             
-            time_elapsed = self.get_player(id).turns - int(t.turn)
+            time_elapsed = turns - int(t.turn)
             weight = 0.0001 * time_elapsed # 15 * 0.0001 = 0.0015
             sum += weight * t.payment
-            print(f"transactions: {t.desc}, {sum}")
+            if debug:
+                log.debug("transactions: %s, %s", t.desc, sum, extra={"player_id": id})
         # debts
         for d in self.get_player_debts(id):
             sum += d.score_impact(self)
-            print(f"debt: {sum}")
+            if debug:
+                log.debug("debt: %s", sum, extra={"player_id": id})
 
         for l in self.get_player_long_terms(id):
             sum += l.receiver_score
-            print(f"long term: {sum}")
+            if debug:
+                log.debug("long term: %s", sum, extra={"player_id": id})
 
-        bias = -4
-        sum += bias
-        sigmoid_num = 1 / (1 + math.exp(-sum))
-        credit_score = sigmoid_num * 500 + 150
-        print(sum, credit_score)
-        return credit_score
+        score = credit_score(sum)
+        log.debug("score sum %s, score %s", sum, score, extra={"player_id": id})
+        return score
+
+    # returns the ids whose aggregated score disagrees with a full scan
+    def check_scores(self, rel_tol=1e-9):
+        mismatched = []
+        for player in self.players:
+            expected = self.scan_player_score(player.id)
+            if not math.isclose(self.player_score(player.id), expected, rel_tol=rel_tol):
+                mismatched.append(player.id)
+        return mismatched
 
     # can be endpoint
     def player_money(self, id):
-        money = 200  # initial starting money
+        return self.balances.get(id, STARTING_MONEY)
+
+    # full scan over the transaction log, reference for the ledger
+    def scan_player_money(self, id):
+        money = STARTING_MONEY
         for t in self.transactions:
             if t.sender_id == id:
                 money -= t.payment
@@ -406,35 +1084,61 @@ class Database:
                 money += t.payment
         return money
 
+    # returns the ids whose ledger balance disagrees with a full scan
+    def check_balances(self):
+        ids = {p.id for p in self.players} | self.balances.keys()
+        return [id for id in sorted(ids) if self.player_money(id) != self.scan_player_money(id)]
+
     # can be endpoint
+    @journaled
     def player_advance_turn(self, player_id):
         player = self.get_player(player_id)
         player.turns += 1
-        if player.turns % 4 == 0:
+        self.touch("players", player.id)
+        if player.turns % ROUND_TURNS == 0:
             self.four_turner(player_id)
 
-    # can be endpoint
+    # can be endpoint, a turn for each of the players, e.g. the whole table at the end of a round
+    @journaled
+    def advance_turns(self, player_ids):
+        for player_id in player_ids:
+            self.player_advance_turn(player_id)
+
+    # can be endpoint. interest on the player's money, then whatever is due on their debts and long
+    # terms by their current turn, popped from their due queue. debts accrue interest each round until
+    # repaid, long terms pay each round and are retired uncharged at the first round past their end
+    # turn. the cost follows the due work, repaid debts and retired long terms drop out of the queue
+    @journaled
     def four_turner(self, player_id):
         player = self.get_player(player_id)
+        turn = player.turns
 
         # interest calculator
         money = self.player_money(player.id)
         interest = int(money * player.interest_rate)
-        bank = self.find_player_by_name(BANK_NAME)
-        self.add_transaction(Transaction.new(self.id_gen, interest, bank.id, player.id, "interest", player.turns, 0, 0))
-        
-        # process debt history
-        for d in self.get_player_debts(player.id):
-            d.add_interest()
+        self.add_transaction(Transaction.new(self.id_gen, interest, BANK_ID, player.id, "interest", turn, 0, 0))
+
+        due = self.due.get(player.id)
+        while due and due[0][0] <= turn:
+            _, id, item = heapq.heappop(due)
+            if isinstance(item, Debt):
+                item.add_interest()
+                self.touch("debts", id)
+                if item.amount != 0:
+                    self.schedule(player.id, item, turn)
+            elif self.long_terms.get(id) is not item:
+                continue  # removed since it was queued
+            elif item.expired(self):
+                self.remove_long_term(item)
+            else:
+                transaction = item.add_interest_and_transaction(self)
+                self.touch("long_terms", id)
+                self.add_transaction(transaction)
+                self.schedule(player.id, item, turn)
+        self.scores.debts_changed(player.id)
 
-        for l in self.get_player_long_terms(player.id):
-            if l.expired(self):
-                self.long_terms.remove(l)
-            transaction = l.add_interest_and_transaction(self)
-            self.add_transaction(transaction)
-
-    # can be endpoint, returning json
-    def player_bank_statement(self, player_id):
+    # can be endpoint
+    def bank_statement(self, player_id, after_id=None, limit=None, turn_from=None, turn_to=None, counterparty=None):
         player = self.get_player(player_id)
 
         # money and credit score
@@ -449,37 +1153,26 @@ class Database:
             "credit_score": score,
             "debts": self.get_player_debts(player.id),
             "long_terms": self.get_player_long_terms(player.id),
-            "transactions": [t for t in self.transactions if t.sender_id == player.id or t.reciever_id == player.id],
+            "transactions": self.query_transactions(after_id, limit, turn_from, turn_to, player.id, counterparty),
         }
 
-        return json.dumps(data, default=lambda o: o.__dict__)
+        # cursor for the next page, None once the player's transactions are exhausted
+        if limit is not None:
+            transactions = data["transactions"]
+            data["next_after_id"] = transactions[-1].id if transactions and len(transactions) == limit else None
 
+        return data
+
+    # can be endpoint, returning json
+    def player_bank_statement(self, player_id):
+        return json.dumps(self.bank_statement(player_id), default=lambda o: o.to_dict())
 
-def new_game():
-    # init the game, need to be moved
-    id_gen = IDGenerator()
-    _bank = Player.new(id_gen, BANK_NAME)
-    _supermarket = Player.new(id_gen, SUPER_MARKET_NAME)
-    _computer_shop = Player.new(id_gen, COMPUTER_SHOP_NAME)
-    _government = Player.new(id_gen, GOV_NAME)
-    _utility = Player.new(id_gen, UTILITY_NAME)
-    _hospital = Player.new(id_gen, HOSPITAL_NAME)
-    _housing = Player.new(id_gen, HOUSING_NAME)
-    _accom = Player.new(id_gen, ACCOM_NAME)
-    _netflex = Player.new(id_gen, NETFLEX_NAME)
-    _scammer = Player.new(id_gen, SCAMMER_NAME)
-    db = Database(id_gen, 24)
-    db.add_player(_bank)
-    db.add_player(_supermarket)
-    db.add_player(_computer_shop)
-    db.add_player(_government)
-    db.add_player(_utility)
-    db.add_player(_hospital)
-    db.add_player(_housing)
-    db.add_player(_accom)
-    db.add_player(_netflex)
-    db.add_player(_scammer)
 
+BOARD_SIZE = 24
+
+
+# the starting board. the action descriptions quote the economy constants, so it is built per settings
+def build_board():
     ACTION_DO_NOTHING = Action("do nothing", "do_nothing")
 
     def default_actions():
@@ -487,242 +1180,579 @@ def new_game():
             ACTION_DO_NOTHING,
         ]
 
-    for i in range(24):
-        db.set_location(i, Location(i, "Boring Place", default_actions()))
+    locations = [Location(i, "Boring Place", default_actions()) for i in range(BOARD_SIZE)]
 
-    db.set_location(1, Location(
+    locations[1] = Location(
         1,
         "Accomodation",
         [
-            Action("pay accomodation rent (1000 pounds)", "rent"),
+            Action(f"pay accomodation rent ({RENT_COST} pounds)", "rent"),
         ]
-    ))
-    db.set_location(3, Location(
+    )
+    locations[3] = Location(
         3,
         "NETFLEX subscription",
         [
-            Action("get netflex subscription (20 pounds)", "get_netflex_subscription"),
+            Action(f"get netflex subscription ({NETFLEX_COST} pounds)", "get_netflex_subscription"),
         ] + default_actions()
-    ))
-    db.set_location(10, Location(
+    )
+    locations[10] = Location(
         10,
         "Supermarket",
         [
-            Action("buy food (50 pounds)", "supermarket_buy_food"),
-            Action("part time (150 pounds)", "supermarket_part_time"),
+            Action(f"buy food ({FOOD_COST} pounds)", "supermarket_buy_food"),
+            Action(f"part time ({PART_TIME_PAY} pounds)", "supermarket_part_time"),
         ] + default_actions()
-    ))
-    db.set_location(11, Location(
+    )
+    locations[11] = Location(
         11,
         "Special Event",
         [
             Action("random event", "scam_event"),
         ]
-    ))
-    db.set_location(12, Location(
+    )
+    locations[12] = Location(
         12,
         "Utility Company",
         [
-            Action("pay utility bill(50 pounds)", "pay_utility_bill"),
+            Action(f"pay utility bill({UTILITY_BILL} pounds)", "pay_utility_bill"),
         ]
-    ))
-    db.set_location(14, Location(
+    )
+    locations[14] = Location(
         14,
         "Gov",
         [
             Action("pay income tax", "income_tax"),
         ]
-    ))
-    db.set_location(16, Location(
+    )
+    locations[16] = Location(
         16,
         "Medical Company",
         [
-            Action("pay medical bill(100 pounds)", "pay_medical_bill"),
+            Action(f"pay medical bill({MEDICAL_BILL} pounds)", "pay_medical_bill"),
         ]
-    ))
-    # db.set_location(18, Location(
+    )
+    # locations[18] = Location(
     #     18,
     #     "Housing Company",
     #     [
     #         Action("purchase property, (500 pounds mortgage)", "pay_mortgage"),
     #     ] + default_actions()
-    # ))
-    db.set_location(20, Location(
+    # )
+    locations[20] = Location(
         20,
         "Computer Shop",
         [
-            Action("buy computer (200 pounds)", "computer_shop_buy_computer"),
+            Action(f"buy computer ({COMPUTER_COST} pounds)", "computer_shop_buy_computer"),
         ] + default_actions()
         
-    ))
+    )
+    return locations
+
+
+# the economy constants the board's descriptions quote
+def board_settings():
+    return (RENT_COST, NETFLEX_COST, FOOD_COST, PART_TIME_PAY, UTILITY_BILL, MEDICAL_BILL, COMPUTER_COST)
+
+
+# the starting board and its encoded payloads, built once per economy settings and shared by every
+# session until it changes a location. Location and Action objects are never changed in place
+class BoardTemplate:
+    __slots__ = ("settings", "locations", "payloads")
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.locations = build_board()
+        self.payloads = board_payloads(self.locations)
+
+
+_board_template = None
+
+
+def board_template():
+    global _board_template
+    settings = board_settings()
+    if _board_template is None or _board_template.settings != settings:
+        _board_template = BoardTemplate(settings)
+    return _board_template
+
+
+# database is the storage backend's Database class, called as database(id_gen, size).
+# the NPCs are added first, so they get the fixed ids in NPC_NAMES order
+def new_game(database=Database):
+    id_gen = IDGenerator()
+    db = database(id_gen, BOARD_SIZE)
+    for name in NPC_NAMES:
+        db.add_player(Player.new(id_gen, name))
+    db.share_board(board_template())
     return db
 
 
-BANK_NAME = "__Bank"
-SUPER_MARKET_NAME = "__Super Market"
-COMPUTER_SHOP_NAME = "__Computer Shop"
-GOV_NAME = "__Government"
-UTILITY_NAME = "__Utility Company"
-HOSPITAL_NAME = "__Medical Company"
-HOUSING_NAME = "__Housing Company"
-ACCOM_NAME = "__Accomodation"
-NETFLEX_NAME = "__NETFLEX"
-SCAMMER_NAME = "__Scammer"
+STARTING_MONEY = 200  # initial starting money
+
+
+# batch operations, each runs against the session database with the op's json fields
+def op_move(db, op):
+    if "location_idx" in op:
+        return db.move_player_abs(db, op["player_id"], op["location_idx"])
+    return db.move_player_rel(db, db.get_player(op["player_id"]), op["n"])
+
+
+def op_run_action(db, op):
+    db.run_action(op["action"], op["player_id"])
+    return {"status": "ok"}
+
+
+def op_borrow(db, op):
+    db.borrow_debt(op["player_id"], op["amount"])
+    return {"status": "ok"}
+
+
+def op_repay(db, op):
+    db.repay_debt(op["debt_id"], op["player_id"], op["amount"])
+    return {"status": "ok"}
+
+
+def op_advance_turn(db, op):
+    db.player_advance_turn(op["player_id"])
+    return {"status": "ok"}
+
+
+def op_money(db, op):
+    return {"money": db.player_money(op["player_id"])}
+
+
+def op_score(db, op):
+    return {"score": db.player_score(op["player_id"])}
+
+
+def op_get_player(db, op):
+    return db.get_player(op["player_id"])
+
+
+def op_statement(db, op):
+    return db.bank_statement(op["player_id"])
+
+
+# op name -> (function, required fields)
+BATCH_OPS = {
+    "move": (op_move, ("player_id",)),
+    "run_action": (op_run_action, ("player_id", "action")),
+    "borrow": (op_borrow, ("player_id", "amount")),
+    "repay": (op_repay, ("player_id", "debt_id", "amount")),
+    "advance_turn": (op_advance_turn, ("player_id",)),
+    "money": (op_money, ("player_id",)),
+    "score": (op_score, ("player_id",)),
+    "get_player": (op_get_player, ("player_id",)),
+    "statement": (op_statement, ("player_id",)),
+}
+
+
+def _is_int(x):
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+# checks a whole batch up front, so a bad op fails the batch before anything is applied.
+# a debt borrowed earlier in the batch does not exist yet, it is known by the id its borrow will draw.
+# borrows and long term actions are the only ops that draw debt ids. returns None or an error message
+def validate_batch(db, ops):
+    if not isinstance(ops, list):
+        return "ops must be a list"
+    next_debt_id = db.id_gen.debt_id_generator
+    borrowed = {}  # debt id -> debtee id, for the debts the batch borrows
+    for op in ops:
+        if not isinstance(op, dict):
+            return "every op must be an object"
+        name = op.get("op")
+        if name not in BATCH_OPS:
+            return f"unknown op: {name}"
+        missing = [f for f in BATCH_OPS[name][1] if f not in op]
+        if missing:
+            return f"{name}: missing {', '.join(missing)}"
+        for field in ("player_id", "n", "location_idx", "debt_id"):
+            if field in op and not _is_int(op[field]):
+                return f"{name}: {field} must be an integer"
+        if "amount" in op and not (_is_int(op["amount"]) or isinstance(op["amount"], float)):
+            return f"{name}: amount must be a number"
+        if db.get_player(op["player_id"]) is None:
+            return f"{name}: no player {op['player_id']}"
+        if name == "move" and "n" not in op and "location_idx" not in op:
+            return "move: needs n or location_idx"
+        if name == "move" and "location_idx" in op and not 0 <= op["location_idx"] < len(db.locations):
+            return f"move: no location {op['location_idx']}"
+        if name == "run_action" and op["action"] not in ACTION_HANDLERS:
+            return f"run_action: unknown action {op['action']}"
+        if name == "run_action" and ACTIONS[op["action"]].kind == "long_term":
+            next_debt_id += 1
+        if name == "borrow":
+            borrowed[next_debt_id] = op["player_id"]
+            next_debt_id += 1
+        if name == "repay":
+            debt = db.get_debt(op["debt_id"])
+            debtee_id = debt.debtee_id if debt is not None else borrowed.get(op["debt_id"])
+            if debtee_id != op["player_id"]:
+                return f"repay: player {op['player_id']} has no debt {op['debt_id']}"
+    return None
+
+
+def run_batch(db, ops):
+    return [BATCH_OPS[op["op"]][0](db, op) for op in ops]
+
 
 # server
+logs.configure()
 app = Flask(__name__)
-db_hashmap = {}
+sessions = SessionManager.from_env(JournalStore.from_env())
+sessions.events = EventHub()
+db_hashmap = sessions.dbs  # resident session -> Database, go through sessions.read/write to use one
+
+
+# model objects and lists of them are encoded by the serializer backend
+def json_response(obj):
+    return Response(serializer.dumps(obj), mimetype="application/json")
+
+
+# json that is already encoded, e.g. a cached board payload
+def encoded_response(body):
+    return Response(body, mimetype="application/json")
+
+
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+TRANSACTION_QUERY_FIELDS = ("after_id", "limit", "turn_from", "turn_to", "player_id", "counterparty")
+STATEMENT_QUERY_FIELDS = ("after_id", "limit", "turn_from", "turn_to", "counterparty")
+EXPORT_QUERY_FIELDS = ("after_id", "turn_from", "turn_to", "player_id", "counterparty")
+
+
+# paging and filter fields from query args or a json body, limits are capped at MAX_PAGE_SIZE
+def transaction_query(args, fields=TRANSACTION_QUERY_FIELDS):
+    query = {f: int(args[f]) for f in fields if args.get(f) is not None}
+    if "limit" in query:
+        query["limit"] = max(0, min(query["limit"], MAX_PAGE_SIZE))
+    return query
+
+
+# the first field transaction_query can't read as an integer, json ints or strings of one
+def validate_query(args, fields=TRANSACTION_QUERY_FIELDS):
+    for f in fields:
+        value = args.get(f)
+        if value is None or _is_int(value):
+            continue
+        if isinstance(value, str):
+            try:
+                int(value)
+                continue
+            except ValueError:
+                pass
+        return f"{f} must be an integer"
+    return None
+
+
+BACKEND = os.environ.get("WHACK_BACKEND", "memory")  # memory or sqlite
+SQLITE_PATH = os.environ.get("WHACK_SQLITE_PATH", "whack.sqlite3")
 
 
+# a new game for the session on the configured storage backend
+def new_session_game(session):
+    if BACKEND == "sqlite":
+        from sqlite_db import SqliteDatabase
+        return new_game(functools.partial(SqliteDatabase, path=SQLITE_PATH, session=session))
+    return new_game()
+
+
+# resident and on-disk session counts and the session cache's hit, miss and eviction counters
+@app.route("/_sessions/stats", methods=["GET"])
+def session_stats():
+    return jsonify(sessions.stats())
+
+
+# scores across sessions in one call, /_sessions/scores?sessions=a,b -> {"sessions": {"a": [...], ...}}.
+# each session is read under its own lock, its scores are consistent but the sessions are read in turn
+@app.route("/_sessions/scores", methods=["GET"])
+def session_scores():
+    names = [name for name in request.args.get("sessions", "").split(",") if name]
+    if not names:
+        return jsonify({"error": "sessions must name at least one session"}), 400
+    for name in names:
+        if name not in sessions:
+            return jsonify({"error": f"no session {name}"}), 404
+    result = {}
+    for name in names:
+        with sessions.read(name) as db:
+            result[name] = score_rows(db)
+    return json_response({"sessions": result})
+
+
+# an existing game is only replaced when asked to, with /<session>/new?reset=1
 @app.route("/<session>/new")
 def server_new(session):
-    db_hashmap[session] = new_game()
+    if session in sessions and request.args.get("reset") != "1":
+        return jsonify({"error": f"session {session} already exists, pass reset=1 to replace it"}), 409
+    sessions.create(session, new_session_game(session))
     return jsonify({"status": "new game created"})
 
 
 @app.route("/<session>/get_location", methods=["POST"])
 def get_location(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    location = db.get_location(data["idx"])
-    return location.json_encode()
+    with sessions.read(session) as db:
+        return encoded_response(db.board_payloads().locations[data["idx"]])
 
 
+# every location in board order. the board rarely changes after new_game, clients revalidate with
+# If-None-Match and get a 304 while it is the same
+@app.route("/<session>/board", methods=["GET"])
+def board(session):
+    with sessions.read(session) as db:
+        payloads = db.board_payloads()
+    response = encoded_response(payloads.board)
+    response.set_etag(payloads.etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+# {"action": ..., "player_id": 10}, or "player_ids": [10, 11] to run it for several players at once
 @app.route("/<session>/run_action", methods=["POST"])
 def run_action(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    db.run_action(data["action"], data["player_id"])
-    return jsonify({"status": "ok"})
+    with sessions.write(session) as db:
+        player_ids = data["player_ids"] if "player_ids" in data else [data["player_id"]]
+        for player_id in player_ids:
+            error = validate_action(db, data["action"], player_id)
+            if error is not None:
+                return jsonify({"error": error}), 400
+        if "player_ids" in data:
+            db.run_action_many(data["action"], player_ids)
+        else:
+            db.run_action(data["action"], data["player_id"])
+        return jsonify({"status": "ok"})
 
 
 @app.route("/<session>/add_player", methods=["POST"])
 def add_player(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    player = Player.new(db.id_gen, data["name"])
-    db.add_player(player)
-    return player.json_encode()
+    with sessions.write(session) as db:
+        return json_response(db.new_player(data["name"]))
 
 
 @app.route("/<session>/find_player_by_name", methods=["POST"])
 def find_player_by_name(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    player = db.find_player_by_name(data["name"])
-    return player.json_encode()
+    with sessions.read(session) as db:
+        player = db.find_player_by_name(data["name"])
+        return json_response(player)
 
 
 @app.route("/<session>/get_player", methods=["POST"])
 def get_player(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    player = db.get_player(data["id"])
-    return player.json_encode()
+    with sessions.read(session) as db:
+        player = db.get_player(data["id"])
+        return json_response(player)
 
 
 @app.route("/<session>/add_debt", methods=["POST"])
 def add_debt(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    debt = Debt.new(db.id_gen, data["debtee_id"], data["start_turn"], data["amount"], data["interest_rate"], data["loaner_id"])
-    db.add_debt(debt)
-    return debt.json_encode()
+    with sessions.write(session) as db:
+        debt = db.new_debt(data["debtee_id"], data["start_turn"], data["amount"], data["interest_rate"], data["loaner_id"])
+        return json_response(debt)
 
 
 @app.route("/<session>/get_debt", methods=["POST"])
 def get_debt(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    debt = db.get_debt(data["id"])
-    return debt.json_encode()
+    with sessions.read(session) as db:
+        debt = db.get_debt(data["id"])
+        return json_response(debt)
 
 
 @app.route("/<session>/get_player_debts", methods=["POST"])
 def get_player_debts(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    print(data)
-    debts = db.get_player_debts(data["player_id"])
-    return f"[{",".join([d.json_encode() for d in debts])}]"
+    log.debug("get_player_debts %s", data, extra={"session": session})
+    with sessions.read(session) as db:
+        debts = db.get_player_debts(data["player_id"])
+        return json_response(debts)
 
 
 @app.route("/<session>/borrow_debt", methods=["POST"])
 def borrow_debt(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    db.borrow_debt(data["player_id"], data["amount"])
-    return jsonify({"status": "ok"})
+    with sessions.write(session) as db:
+        db.borrow_debt(data["player_id"], data["amount"])
+        return jsonify({"status": "ok"})
 
 
 @app.route("/<session>/repay_debt", methods=["POST"])
 def repay_debt(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    db.repay_debt(data["debt_id"], data["debtee_id"], data["amount"])
-    return jsonify({"status": "ok"})
+    with sessions.write(session) as db:
+        db.repay_debt(data["debt_id"], data["debtee_id"], data["amount"])
+        return jsonify({"status": "ok"})
 
 
 @app.route("/<session>/move_player_rel", methods=["POST"])
 def move_player_rel(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    player = db.get_player(data["player_id"])
-    location = db.move_player_rel(db, player, data["n"])
-    return location.json_encode()
+    with sessions.write(session) as db:
+        player = db.get_player(data["player_id"])
+        db.move_player_rel(db, player, data["n"])
+        return encoded_response(db.board_payloads().locations[player.location_idx])
 
 
 @app.route("/<session>/move_player_abs", methods=["POST"])
 def move_player_abs(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    location = db.move_player_abs(db, data["player_id"], data["location_idx"])
-    return location.json_encode()
+    with sessions.write(session) as db:
+        db.move_player_abs(db, data["player_id"], data["location_idx"])
+        return encoded_response(db.board_payloads().locations[data["location_idx"]])
 
 
 @app.route("/<session>/add_transaction", methods=["POST"])
 def add_transaction(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    transaction = Transaction.new(db.id_gen, **data)
-    db.add_transaction(transaction)
-    return transaction.json_encode()
+    with sessions.write(session) as db:
+        return json_response(db.new_transaction(data))
 
 
+# without query args this is still the whole log, page with ?after_id=<last id>&limit=<n>
 @app.route("/<session>/get_transactions", methods=["GET"])
 def get_transactions(session):
-    db = db_hashmap[session]
-    return f"[{",".join([t.json_encode() for t in db.get_transactions()])}]"
+    error = validate_query(request.args)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    with sessions.read(session) as db:
+        return json_response(db.query_transactions(**transaction_query(request.args)))
+
+
+# the whole (filtered) log as one json array, encoded and sent a chunk at a time
+@app.route("/<session>/export_transactions", methods=["GET"])
+def export_transactions(session):
+    error = validate_query(request.args, EXPORT_QUERY_FIELDS)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    with sessions.read(session) as db:
+        chunks = db.transaction_chunks(EXPORT_CHUNK_SIZE, **transaction_query(request.args, EXPORT_QUERY_FIELDS))
+
+        def generate():
+            yield b"["
+            for i, chunk in enumerate(chunks):
+                if i > 0:
+                    yield b","
+                yield serializer.dumps(chunk)[1:-1]
+            yield b"]"
+
+        return Response(generate(), mimetype="application/json")
+
+
+# poll with the version cursor from the previous response, no cursor fetches the whole session
+@app.route("/<session>/changes", methods=["GET"])
+def changes(session):
+    with sessions.read(session) as db:
+        return json_response(db.changes(request.args.get("since", "")))
+
+
+# server-sent events with what changed after every write, see events.py. each open stream holds a
+# server thread, run behind a threaded server or use the asgi variant for many clients
+@app.route("/<session>/events", methods=["GET"])
+def events(session):
+    if session not in sessions:
+        return jsonify({"error": f"no session {session}"}), 404
+    since = request.headers.get("Last-Event-ID") or request.args.get("since", "")
+    return Response(
+        sessions.events.stream(sessions, session, since),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/<session>/player_score", methods=["POST"])
 def player_score(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    score = db.player_score(data["id"])
-    return jsonify({"score": score})
+    with sessions.read(session) as db:
+        score = db.player_score(data["id"])
+        return jsonify({"score": score})
+
+
+# every player's id, name and score, for /<session>/scores and /_sessions/scores
+def score_rows(db):
+    scores = db.all_player_scores()
+    return [{"id": p.id, "name": p.name, "score": scores[p.id]} for p in db.players]
+
+
+@app.route("/<session>/scores", methods=["GET"])
+def scores(session):
+    with sessions.read(session) as db:
+        return jsonify({"scores": score_rows(db)})
 
 
 @app.route("/<session>/player_money", methods=["POST"])
 def player_money(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    money = db.player_money(data["id"])
-    return jsonify({"money": money})
+    with sessions.read(session) as db:
+        money = db.player_money(data["id"])
+        return jsonify({"money": money})
 
 
 @app.route("/<session>/player_bank_statement", methods=["POST"])
 def player_bank_statement(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    result = db.player_bank_statement(data["player_id"])
-    return result  # Already JSON encoded
+    error = validate_query(data, STATEMENT_QUERY_FIELDS)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    with sessions.read(session) as db:
+        return json_response(db.bank_statement(data["player_id"], **transaction_query(data, STATEMENT_QUERY_FIELDS)))
+
+
+# a whole turn in one request: {"ops": [{"op": "move", "player_id": 10, "n": 4}, ...]}
+@app.route("/<session>/batch", methods=["POST"])
+def batch(session):
+    data = request.get_json()
+    with sessions.write(session) as db:
+        ops = data["ops"]
+        error = validate_batch(db, ops)
+        if error is not None:
+            return jsonify({"error": error}), 400
+        return json_response({"results": run_batch(db, ops)})
+
 
 @app.route("/<session>/player_advance_turn", methods=["POST"])
 def player_advance_turn(session):
     data = request.get_json()
-    db = db_hashmap[session]
-    db.player_advance_turn(data["player_id"])
+    player_ids = data["player_ids"] if "player_ids" in data else [data["player_id"]]
+    with sessions.write(session) as db:
+        error = validate_players(db, player_ids)
+        if error is not None:
+            return jsonify({"error": error}), 400
+        if "player_ids" in data:
+            db.advance_turns(player_ids)
+        else:
+            db.player_advance_turn(data["player_id"])
+        return jsonify({"status": "ok"})
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(sessions), mimetype="text/plain; version=0.0.4")
+
+
+# the sampling profiler, POST /_profiler/start?interval=0.005 then /_profiler/stop for the folded stacks
+@app.route("/_profiler/start", methods=["POST"])
+def profiler_start():
+    if not metrics.profiler.start(float(request.args.get("interval", 0.005))):
+        return jsonify({"error": "the profiler is already running"}), 409
     return jsonify({"status": "ok"})
-    
 
+
+@app.route("/_profiler/stop", methods=["POST"])
+def profiler_stop():
+    if not metrics.profiler.running():
+        return jsonify({"error": "the profiler is not running"}), 409
+    return Response(metrics.profiler.stop(), mimetype="text/plain")
+
+
+# timing every Database method and route costs about a microsecond a call, so it is off by default
+if metrics.enabled():
+    metrics.instrument_class(Database)
+    metrics.instrument_app(app)
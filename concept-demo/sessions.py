@@ -0,0 +1,276 @@
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote
+
+
+# readers-writer lock, writers are preferred so a stream of reads cannot starve a turn
+class RWLock:
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+# session name -> Database, with one readers-writer lock per session.
+# money, score and statement reads on a session run in parallel, mutations run alone.
+# with a JournalStore every session is durable and the ones on disk are loaded on their first request.
+# with a budget (max_sessions, max_bytes of Database.estimated_bytes) the least recently used sessions
+# are evicted to disk and reloaded transparently: through the JournalStore when there is one,
+# otherwise as pickles in spill_dir
+class SessionManager:
+
+    def __init__(self, store=None, max_sessions=None, max_bytes=None, spill_dir=None):
+        self.dbs = {}  # resident sessions only
+        self.locks = {}  # every known session, resident or on disk
+        self._lock = threading.Lock()  # guards the dicts, lru, sizes, evicted and the counters
+        self.store = store
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.lru = OrderedDict()  # resident sessions, least recently used first
+        self.sizes = {}  # resident session -> estimated bytes when its last write finished
+        self.resident_bytes = 0
+        self.evicted = set()  # known sessions that are on disk only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.events = None  # an EventHub, told about every write and new game, see events.py
+        if store is not None:
+            for session in store.sessions():
+                self.locks[session] = RWLock()
+                self.evicted.add(session)
+
+    # budgets from WHACK_MAX_SESSIONS and WHACK_MAX_SESSION_MB, unbounded when unset
+    @classmethod
+    def from_env(cls, store=None):
+        max_sessions = os.environ.get("WHACK_MAX_SESSIONS")
+        max_mb = os.environ.get("WHACK_MAX_SESSION_MB")
+        return cls(
+            store,
+            max_sessions=int(max_sessions) if max_sessions else None,
+            max_bytes=int(float(max_mb) * 2**20) if max_mb else None,
+            spill_dir=os.environ.get("WHACK_SPILL_DIR"),
+        )
+
+    # replaces any existing game, once requests already running on it have finished
+    def create(self, session, db):
+        with self._lock:
+            lock = self.locks.setdefault(session, RWLock())
+        lock.acquire_write()
+        try:
+            if self.store is not None:
+                self.store.attach(session, db)
+            elif session in self.evicted:
+                os.remove(self._spill_path(session))
+            self.dbs[session] = db
+            self._resident(session, db)
+            if self.events is not None:
+                self.events.publish(session)
+        finally:
+            lock.release_write()
+        self._evict()
+
+    # drops a session once requests already running on it have finished, returns its Database
+    def remove(self, session):
+        lock, db = self._open(session, write=True)
+        try:
+            del self.dbs[session]
+            if self.store is not None:
+                self.store.drop(session)
+            with self._lock:
+                del self.lru[session]
+                self.resident_bytes -= self.sizes.pop(session)
+                self.locks.pop(session, None)
+            if self.events is not None:
+                self.events.publish(session)
+        finally:
+            lock.release_write()
+        return db
+
+    # forgets the sessions on disk that owns(session) rejects, they are served by another process
+    # sharing the data dir, e.g. another shard.py worker
+    def claim(self, owns):
+        with self._lock:
+            for session in [s for s in self.evicted if not owns(s)]:
+                self.evicted.discard(session)
+                del self.locks[session]
+
+    def __contains__(self, session):
+        return session in self.locks
+
+    def __iter__(self):
+        return iter(list(self.locks))
+
+    def __len__(self):
+        return len(self.locks)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resident": len(self.dbs),
+                "on_disk": len(self.evicted),
+                "resident_bytes": self.resident_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    # raises KeyError for an unknown session, like the plain dict did
+    def _session_lock(self, session):
+        with self._lock:
+            return self.locks[session]
+
+    # takes the session lock with the session resident, loading it from disk first if it was evicted
+    def _open(self, session, write):
+        lock = self._session_lock(session)
+        acquire, release = (lock.acquire_write, lock.release_write) if write else (lock.acquire_read, lock.release_read)
+        loaded = False
+        while True:
+            acquire()
+            db = self.dbs.get(session)
+            if db is not None:
+                with self._lock:
+                    self.lru.move_to_end(session)
+                    if not loaded:
+                        self.hits += 1
+                return lock, db
+            release()
+
+            # a concurrent eviction can run between the load and the acquire above, then go round again
+            lock.acquire_write()
+            try:
+                if session not in self.dbs:
+                    self._load(session)
+                    loaded = True
+            finally:
+                lock.release_write()
+
+    # called with the session's write lock held
+    def _load(self, session):
+        with self._lock:
+            if session not in self.evicted:
+                raise KeyError(session)  # still being created
+        if self.store is not None:
+            db = self.store.load(session)
+        else:
+            path = self._spill_path(session)
+            with open(path, "rb") as f:
+                db = pickle.load(f)
+            os.remove(path)
+        self.dbs[session] = db
+        with self._lock:
+            self.evicted.discard(session)
+            self.misses += 1
+        self._resident(session, db)
+
+    def _resident(self, session, db):
+        size = db.estimated_bytes()
+        with self._lock:
+            self.evicted.discard(session)
+            self.lru[session] = None
+            self.lru.move_to_end(session)
+            self.resident_bytes += size - self.sizes.get(session, 0)
+            self.sizes[session] = size
+
+    def _over_budget(self):
+        if self.max_sessions is not None and len(self.lru) > self.max_sessions:
+            return True
+        return self.max_bytes is not None and self.resident_bytes > self.max_bytes and len(self.lru) > 1
+
+    # evicts least recently used sessions until the budget holds. runs with no session lock held,
+    # so waiting on a victim's lock cannot deadlock against a request that is evicting ours
+    def _evict(self):
+        while True:
+            with self._lock:
+                if not self._over_budget():
+                    return
+                victim = next(iter(self.lru))
+                lock = self.locks[victim]
+            lock.acquire_write()
+            try:
+                with self._lock:
+                    if victim not in self.dbs or not self._over_budget():
+                        continue
+                self._spill(victim)
+            finally:
+                lock.release_write()
+
+    # called with the session's write lock held
+    def _spill(self, session):
+        db = self.dbs[session]
+        if self.store is not None:
+            # a fresh snapshot makes the reload a single read
+            db.journal.snapshot(db)
+            self.store.flush()
+        else:
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix="whack-sessions-")
+            path = self._spill_path(session)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(db, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        del self.dbs[session]
+        with self._lock:
+            del self.lru[session]
+            self.resident_bytes -= self.sizes.pop(session)
+            self.evicted.add(session)
+            self.evictions += 1
+
+    def _spill_path(self, session):
+        return os.path.join(self.spill_dir, quote(session, safe="") + ".pickle")
+
+    @contextmanager
+    def read(self, session):
+        lock, db = self._open(session, write=False)
+        try:
+            yield db
+        finally:
+            lock.release_read()
+            self._evict()
+
+    @contextmanager
+    def write(self, session):
+        lock, db = self._open(session, write=True)
+        try:
+            yield db
+        finally:
+            # a failed commit must not leave the session locked for good
+            try:
+                db.commit()
+                self._resident(session, db)
+                if self.events is not None:
+                    self.events.publish(session)
+            finally:
+                lock.release_write()
+            self._evict()
@@ -0,0 +1,272 @@
+import argparse
+import hashlib
+import http.client
+import json
+import multiprocessing
+import pickle
+import secrets
+import threading
+import time
+from bisect import bisect_right
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+from flask import request, abort, jsonify, Response
+from werkzeug.serving import make_server
+
+import serializer
+import server
+from sessions import RWLock
+
+# runs the game server as N worker processes, each owning the sessions that hash to it,
+# behind a dispatcher that forwards every request to the owner of its <session> segment:
+#   python shard.py --workers 4 --port 5000
+# POST /_shard/workers on the dispatcher starts one more worker and moves the sessions it now owns
+
+
+# the headers the dispatcher passes on, the conditional ones so /<session>/board can answer 304
+FORWARDED_REQUEST_HEADERS = (("CONTENT_TYPE", "Content-Type"), ("HTTP_IF_NONE_MATCH", "If-None-Match"))
+FORWARDED_RESPONSE_HEADERS = ("content-type", "etag", "cache-control")
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+# consistent hash ring with virtual nodes, adding a node only moves the keys it takes over
+class HashRing:
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = list(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        i = bisect_right(self.hashes, _hash(key)) % len(self.hashes)
+        return self.owners[i]
+
+
+# routes a worker serves to the dispatcher only, for moving sessions between workers
+def install_shard_routes(app, secret):
+
+    def check_secret():
+        if request.headers.get("X-Shard-Secret") != secret:
+            abort(403)
+
+    @app.route("/_shard/sessions", methods=["GET"])
+    def shard_sessions():
+        check_secret()
+        return jsonify(list(server.sessions))
+
+    # pickles the session and drops it from this worker
+    @app.route("/_shard/export/<session>", methods=["POST"])
+    def shard_export(session):
+        check_secret()
+        db = server.sessions.remove(session)
+        return Response(pickle.dumps(db, protocol=pickle.HIGHEST_PROTOCOL), mimetype="application/octet-stream")
+
+    @app.route("/_shard/import/<session>", methods=["POST"])
+    def shard_import(session):
+        check_secret()
+        server.sessions.create(session, pickle.loads(request.get_data()))
+        return jsonify({"status": "ok"})
+
+
+# url is the worker's own and nodes the ring it starts in, it serves only the sessions on disk the
+# ring assigns to it. sessions it takes over later are moved to it by Cluster.add_worker
+def serve_worker(port, secret, url, nodes):
+    ring = HashRing(nodes)
+    server.sessions.claim(lambda session: ring.owner(session) == url)
+    install_shard_routes(server.app, secret)
+    make_server("127.0.0.1", port, server.app, threaded=True).serve_forever()
+
+
+class Cluster:
+
+    def __init__(self, workers, base_port, secret=None):
+        self.base_port = base_port
+        self.secret = secret or secrets.token_hex(16)
+        self.processes = {}  # worker url -> process
+        self.local = threading.local()  # per-thread keep-alive connections to the workers
+        self.lock = RWLock()  # requests share it, rebalancing takes it alone
+        urls = [self._worker_url(i) for i in range(workers)]
+        for url in urls:
+            self.start_worker(url, urls)
+        self.ring = HashRing(self.processes)
+
+    def _worker_url(self, i):
+        return f"http://127.0.0.1:{self.base_port + i + 1}"
+
+    # nodes is the ring the worker starts in, see serve_worker
+    def start_worker(self, url, nodes):
+        process = multiprocessing.Process(target=serve_worker, args=(urlsplit(url).port, self.secret, url, nodes), daemon=True)
+        process.start()
+        self.processes[url] = process
+        self._wait_ready(url)
+        return url
+
+    def _wait_ready(self, url, timeout=15):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.call(url, "GET", "/_shard/sessions")
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                self._drop_connection(url)
+                time.sleep(0.1)
+
+    def _connection(self, url):
+        conns = self.local.__dict__.setdefault("conns", {})
+        if url not in conns:
+            parts = urlsplit(url)
+            conns[url] = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        return conns[url]
+
+    def _drop_connection(self, url):
+        conn = self.local.__dict__.get("conns", {}).pop(url, None)
+        if conn is not None:
+            conn.close()
+
+    # one request to a worker, returns (status, headers, body)
+    def call(self, url, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        headers["X-Shard-Secret"] = self.secret
+        conn = self._connection(url)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.getheaders(), response.read()
+        except (http.client.HTTPException, OSError):
+            self._drop_connection(url)
+            raise
+
+    # starts a worker and moves every session the new ring assigns to it
+    def add_worker(self):
+        url = self._worker_url(len(self.processes))
+        self.start_worker(url, list(self.processes) + [url])
+        self.lock.acquire_write()
+        try:
+            ring = HashRing(self.processes)
+            moved = 0
+            for old in self.ring.nodes:
+                _, _, body = self.call(old, "GET", "/_shard/sessions")
+                for session in json.loads(body):
+                    if ring.owner(session) != old:
+                        _, _, payload = self.call(old, "POST", f"/_shard/export/{quote(session, safe='')}")
+                        self.call(ring.owner(session), "POST", f"/_shard/import/{quote(session, safe='')}", payload)
+                        moved += 1
+            self.ring = ring
+        finally:
+            self.lock.release_write()
+        return url, moved
+
+    # wsgi dispatcher
+    def __call__(self, environ, start_response):
+        # wsgi hands over the unescaped path as latin-1, the workers hash and route on the utf-8 text
+        path = environ.get("PATH_INFO", "/").encode("latin-1").decode("utf-8", "replace")
+        method = environ["REQUEST_METHOD"]
+
+        if path == "/_shard/workers" and method == "POST":
+            url, moved = self.add_worker()
+            return self._respond(start_response, 200, [("Content-Type", "application/json")],
+                                 serializer.dumps({"worker": url, "workers": len(self.processes), "moved_sessions": moved}))
+        if path == "/_sessions/scores" and method == "GET":
+            return self._scores(start_response, environ.get("QUERY_STRING", ""))
+        session = path.strip("/").split("/")[0]
+        if not session or session.startswith("_"):
+            return self._respond(start_response, 404, [("Content-Type", "text/plain")], b"not found")
+
+        query = environ.get("QUERY_STRING")
+        target = quote(path) + ("?" + query if query else "")
+        if path.endswith("/events") and method == "GET":
+            self.lock.acquire_read()
+            try:
+                owner = self.ring.owner(session)
+            finally:
+                self.lock.release_read()
+            return self._stream(start_response, owner, target, environ.get("HTTP_LAST_EVENT_ID"))
+
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else None
+        headers = {name: environ[key] for key, name in FORWARDED_REQUEST_HEADERS if environ.get(key)}
+
+        self.lock.acquire_read()
+        try:
+            status, response_headers, data = self.call(self.ring.owner(session), method, target, body, headers)
+        finally:
+            self.lock.release_read()
+        keep = [(k, v) for k, v in response_headers if k.lower() in FORWARDED_RESPONSE_HEADERS]
+        return self._respond(start_response, status, keep, data)
+
+    # /_sessions/scores asks each owner for its share of the sessions and merges the answers in the
+    # order they were asked for. the first error from a worker is passed on as it is
+    def _scores(self, start_response, query):
+        names = [name for name in parse_qs(query).get("sessions", [""])[0].split(",") if name]
+        if not names:
+            return self._respond(start_response, 400, [("Content-Type", "application/json")],
+                                 serializer.dumps({"error": "sessions must name at least one session"}))
+        self.lock.acquire_read()
+        try:
+            by_owner = {}
+            for name in names:
+                by_owner.setdefault(self.ring.owner(name), []).append(name)
+            merged = {}
+            for url, owned in by_owner.items():
+                status, response_headers, data = self.call(url, "GET", "/_sessions/scores?" + urlencode({"sessions": ",".join(owned)}))
+                if status != 200:
+                    keep = [(k, v) for k, v in response_headers if k.lower() in FORWARDED_RESPONSE_HEADERS]
+                    return self._respond(start_response, status, keep, data)
+                merged.update(json.loads(data)["sessions"])
+        finally:
+            self.lock.release_read()
+        return self._respond(start_response, 200, [("Content-Type", "application/json")],
+                             serializer.dumps({"sessions": {name: merged[name] for name in names}}))
+
+    # an event stream is passed through as it arrives, on a connection of its own. it ends when the
+    # session moves to another worker and the client's EventSource reconnects to the new owner
+    def _stream(self, start_response, url, target, last_event_id):
+        parts = urlsplit(url)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        headers = {"X-Shard-Secret": self.secret}
+        if last_event_id:
+            headers["Last-Event-ID"] = last_event_id
+        conn.request("GET", target, headers=headers)
+        response = conn.getresponse()
+        reason = http.client.responses.get(response.status, "")
+        keep = [(k, v) for k, v in response.getheaders() if k.lower() in ("content-type", "cache-control")]
+        start_response(f"{response.status} {reason}", keep)
+
+        def chunks():
+            try:
+                while chunk := response.read1(65536):
+                    yield chunk
+            finally:
+                conn.close()
+
+        return chunks()
+
+    def _respond(self, start_response, status, headers, body):
+        reason = http.client.responses.get(status, "")
+        start_response(f"{status} {reason}", headers + [("Content-Length", str(len(body)))])
+        return [body]
+
+    def shutdown(self):
+        for process in self.processes.values():
+            process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run the game server sharded across worker processes")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    cluster = Cluster(args.workers, args.port)
+    print(f"dispatching to {args.workers} workers on http://{args.host}:{args.port}")
+    try:
+        make_server(args.host, args.port, cluster, threaded=True).serve_forever()
+    finally:
+        cluster.shutdown()
@@ -0,0 +1,224 @@
+import argparse
+import ast
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import server
+
+# headless monte-carlo games against new_game() and Database, for tuning the economy:
+#   python simulate.py --games 2000 --players 4 --turns 100
+#   python simulate.py --policies greedy,debt_averse --set RENT_COST=800 --set DEBT_INTEREST_RATE=0.08
+# a turn follows client2.py: one menu choice (move, paycheck, borrow or repay), then player_advance_turn.
+# a move rolls two dice and runs one of the location's actions, the scam event is the client's prompt
+
+PAYCHECK = 100  # the clients' paycheck option
+BORROW_AMOUNT = 500
+SCAM_PRIZE = 1000  # what the scam promises
+
+
+# money a location action pays (positive) or costs (negative) this round, read from the action table
+def action_value(func):
+    if func == "scam_event":
+        return SCAM_PRIZE  # as advertised
+    spec = server.ACTIONS.get(func)
+    if spec is None or spec.kind == "none":
+        return 0
+    amount = getattr(server, spec.amount)
+    return -amount if spec.kind == "payment" else spec.sign * amount
+
+
+def active_debts(db, player):
+    return [d for d in db.get_player_debts(player.id) if d.amount > 0]
+
+
+# a policy makes every decision a player at the table would
+class Policy:
+    name = None
+
+    # "move", "paycheck", "borrow" or "repay"
+    def choose(self, rnd, db, player):
+        raise NotImplementedError
+
+    # one of the location's action funcs
+    def pick_action(self, rnd, funcs):
+        raise NotImplementedError
+
+    def falls_for_scam(self, rnd):
+        raise NotImplementedError
+
+
+class RandomPolicy(Policy):
+    name = "random"
+
+    def choose(self, rnd, db, player):
+        options = ["move", "paycheck", "borrow"]
+        if active_debts(db, player) and db.player_money(player.id) > 0:
+            options.append("repay")
+        return rnd.choice(options)
+
+    def pick_action(self, rnd, funcs):
+        return rnd.choice(funcs)
+
+    def falls_for_scam(self, rnd):
+        return rnd.random() < 0.5
+
+
+# always moves, borrows to stay liquid, never repays and takes whatever pays most right now
+class GreedyPolicy(Policy):
+    name = "greedy"
+
+    def choose(self, rnd, db, player):
+        return "borrow" if db.player_money(player.id) < 0 else "move"
+
+    def pick_action(self, rnd, funcs):
+        return max(funcs, key=action_value)
+
+    def falls_for_scam(self, rnd):
+        return True
+
+
+# never borrows, works a paycheck when broke, repays debts as soon as it can and ignores the scam
+class DebtAversePolicy(Policy):
+    name = "debt_averse"
+
+    def choose(self, rnd, db, player):
+        money = db.player_money(player.id)
+        if money < 0:
+            return "paycheck"
+        if active_debts(db, player) and money > 0:
+            return "repay"
+        return "move"
+
+    def pick_action(self, rnd, funcs):
+        return max(funcs, key=action_value)
+
+    def falls_for_scam(self, rnd):
+        return False
+
+
+POLICIES = {policy.name: policy for policy in (RandomPolicy(), GreedyPolicy(), DebtAversePolicy())}
+
+
+def play_turn(db, rnd, player, policy, bank):
+    choice = policy.choose(rnd, db, player)
+    if choice == "move":
+        location = db.move_player_rel(db, player, rnd.randint(1, 6) + rnd.randint(1, 6))
+        if location.actions:
+            func = policy.pick_action(rnd, [a.func for a in location.actions])
+            if func != "scam_event":
+                db.run_action(func, player.id)
+            elif policy.falls_for_scam(rnd):
+                db.run_action("scammed_20", player.id)
+    elif choice == "paycheck":
+        db.add_transaction(server.Transaction.new(db.id_gen, PAYCHECK, bank.id, player.id, "paycheck", player.turns, 0, 0))
+    elif choice == "borrow":
+        db.borrow_debt(player.id, BORROW_AMOUNT)
+    elif choice == "repay":
+        debt = max(active_debts(db, player), key=lambda d: d.amount)
+        db.repay_debt(debt.id, player.id, min(debt.amount, db.player_money(player.id)))
+    db.player_advance_turn(player.id)
+
+
+# one game, the players take the policies in order. returns (policy, money, score, debt) per player
+def play_game(seed, policies, turns):
+    rnd = random.Random(seed)
+    db = server.new_game()
+    bank = db.find_player_by_name(server.BANK_NAME)
+    players = []
+    for i, name in enumerate(policies):
+        player = server.Player.new(db.id_gen, f"{name} {i}")
+        db.add_player(player)
+        players.append((player, POLICIES[name]))
+
+    for _ in range(turns):
+        for player, policy in players:
+            play_turn(db, rnd, player, policy, bank)
+
+    # scores of players deep in debt overflow the sigmoid, it saturates at the bottom of the range
+    with np.errstate(over="ignore"):
+        scores = db.all_player_scores()
+    return [
+        (policy.name, db.player_money(player.id), scores[player.id], sum(d.amount for d in db.get_player_debts(player.id)))
+        for player, policy in players
+    ]
+
+
+# economy overrides, applied in every worker process before it plays
+def apply_settings(settings):
+    for name, value in settings.items():
+        setattr(server, name, value)
+
+
+def parse_setting(text):
+    name, _, value = text.partition("=")
+    if not name.isupper() or not hasattr(server, name):
+        raise argparse.ArgumentTypeError(f"{name} is not an economy constant in server.py")
+    return name, ast.literal_eval(value)
+
+
+def percentiles(values):
+    return dict(zip(("p5", "p25", "p50", "p75", "p95"), (float(x) for x in np.percentile(values, [5, 25, 50, 75, 95]))))
+
+
+def summarize(results):
+    by_policy = {}
+    for game in results:
+        for name, money, score, debt in game:
+            by_policy.setdefault(name, []).append((money, score, debt))
+    summary = {}
+    for name, rows in sorted(by_policy.items()):
+        money, score, debt = (np.array(column, dtype=np.float64) for column in zip(*rows))
+        summary[name] = {
+            "players": len(rows),
+            "money_mean": float(money.mean()),
+            "money": percentiles(money),
+            "broke": float((money < 0).mean()),
+            "score_mean": float(score.mean()),
+            "score": percentiles(score),
+            "debt_mean": float(debt.mean()),
+        }
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simulate many games and report money and credit score distributions")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=3, help="players per game, they take the policies in turn")
+    parser.add_argument("--turns", type=int, default=60, help="turns per player")
+    parser.add_argument("--policies", default=",".join(POLICIES))
+    parser.add_argument("--set", type=parse_setting, action="append", default=[], metavar="NAME=VALUE",
+                        help="override an economy constant, e.g. RENT_COST=800")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+
+    policies = args.policies.split(",")
+    for name in policies:
+        if name not in POLICIES:
+            parser.error(f"unknown policy {name}, choose from {', '.join(POLICIES)}")
+    seats = [policies[i % len(policies)] for i in range(args.players)]
+    settings = dict(args.set)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, initializer=apply_settings, initargs=(settings,)) as pool:
+        seeds = range(args.seed, args.seed + args.games)
+        chunksize = max(1, args.games // (args.workers * 4))
+        results = list(pool.map(play_game, seeds, [seats] * args.games, [args.turns] * args.games, chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+    turns = args.games * args.players * args.turns
+    summary = summarize(results)
+
+    if args.json:
+        print(json.dumps({"settings": settings, "turns": turns, "seconds": elapsed, "policies": summary}, indent=2))
+    else:
+        print(f"{turns} turns in {elapsed:.1f}s, {turns / elapsed * 60:,.0f} turns/min on {args.workers} workers")
+        print(f"{'policy':<12} {'players':>7} {'money p5':>9} {'p50':>8} {'p95':>8} {'broke':>6} {'score p5':>9} {'p50':>7} {'p95':>7} {'debt':>8}")
+        for name, s in summary.items():
+            print(f"{name:<12} {s['players']:>7} {s['money']['p5']:>9.0f} {s['money']['p50']:>8.0f} {s['money']['p95']:>8.0f} "
+                  f"{s['broke']:>6.0%} {s['score']['p5']:>9.1f} {s['score']['p50']:>7.1f} {s['score']['p95']:>7.1f} {s['debt_mean']:>8.0f}")
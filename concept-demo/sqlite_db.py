@@ -0,0 +1,323 @@
+import sqlite3
+import threading
+
+import metrics
+from server import Database, Transaction, credit_score, STARTING_MONEY
+
+# Database over SQLite, a local stand-in for the hosted store. select it with WHACK_BACKEND=sqlite,
+# the file is WHACK_SQLITE_PATH (whack.sqlite3 by default) and every session keeps its rows in it.
+#
+# transactions live only in the file, so a session's log is not bounded by memory. players, debts and
+# long terms are few and the game mutates them in place, so they stay cached as objects and are
+# written through whenever they are touched. money and scores are SQL aggregates over the tables,
+# v_player_money and v_player_score are the views the react app reads from the hosted store.
+# writes are queued and go to the file in one transaction per request, on commit()
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS players (
+    session TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    location_idx INTEGER NOT NULL,
+    interest_rate REAL NOT NULL,
+    turns INTEGER NOT NULL,
+    PRIMARY KEY (session, id)
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    session TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    payment NUMERIC NOT NULL,
+    sender_id INTEGER NOT NULL,
+    receiver_id INTEGER NOT NULL,
+    desc TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    base_from_score NUMERIC NOT NULL,
+    base_to_score NUMERIC NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (session, id)
+);
+CREATE INDEX IF NOT EXISTS transactions_sender ON transactions (session, sender_id, payment, base_from_score);
+CREATE INDEX IF NOT EXISTS transactions_receiver ON transactions (session, receiver_id, payment, base_to_score);
+CREATE INDEX IF NOT EXISTS transactions_turn ON transactions (session, turn, payment);
+CREATE INDEX IF NOT EXISTS transactions_version ON transactions (session, version);
+CREATE TABLE IF NOT EXISTS debts (
+    session TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    debtee_id INTEGER NOT NULL,
+    loaner_id INTEGER NOT NULL,
+    start_turn INTEGER NOT NULL,
+    amount NUMERIC NOT NULL,
+    interest_rate REAL NOT NULL,
+    PRIMARY KEY (session, id)
+);
+CREATE INDEX IF NOT EXISTS debts_debtee ON debts (session, debtee_id);
+CREATE TABLE IF NOT EXISTS long_terms (
+    session TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    receiver_id INTEGER NOT NULL,
+    sender_id INTEGER NOT NULL,
+    start_turn INTEGER NOT NULL,
+    end_turn INTEGER NOT NULL,
+    desc TEXT NOT NULL,
+    amount NUMERIC NOT NULL,
+    interest_rate REAL NOT NULL,
+    sender_score NUMERIC NOT NULL,
+    receiver_score NUMERIC NOT NULL,
+    PRIMARY KEY (session, id)
+);
+CREATE INDEX IF NOT EXISTS long_terms_receiver ON long_terms (session, receiver_id);
+
+CREATE VIEW IF NOT EXISTS v_player_money AS
+SELECT p.session, p.id AS player_id,
+    {STARTING_MONEY}
+    + COALESCE((SELECT SUM(t.payment) FROM transactions t WHERE t.session = p.session AND t.receiver_id = p.id), 0)
+    - COALESCE((SELECT SUM(t.payment) FROM transactions t WHERE t.session = p.session AND t.sender_id = p.id), 0) AS money
+FROM players p;
+
+-- the same terms as scan_player_score. the time decay over every transaction of the session is
+-- turns * sum(payment) - sum(payment * turn), debt impacts are truncated per debt like Debt.score_impact
+CREATE VIEW IF NOT EXISTS v_player_score_sum AS
+SELECT p.session, p.id AS player_id,
+    COALESCE((SELECT SUM(t.base_from_score) FROM transactions t WHERE t.session = p.session AND t.sender_id = p.id), 0)
+    + COALESCE((SELECT SUM(t.base_to_score) FROM transactions t WHERE t.session = p.session AND t.receiver_id = p.id), 0)
+    + 0.0001 * (p.turns * s.payment_sum - s.payment_turn_sum)
+    + COALESCE((SELECT SUM(CAST(-(p.turns - d.start_turn) * d.amount * 0.0001 AS INTEGER))
+                FROM debts d WHERE d.session = p.session AND d.debtee_id = p.id), 0)
+    + COALESCE((SELECT SUM(l.receiver_score) FROM long_terms l WHERE l.session = p.session AND l.receiver_id = p.id), 0) AS sum
+FROM players p
+JOIN (SELECT p2.session,
+             COALESCE((SELECT SUM(t.payment) FROM transactions t WHERE t.session = p2.session), 0) AS payment_sum,
+             COALESCE((SELECT SUM(t.payment * t.turn) FROM transactions t WHERE t.session = p2.session), 0) AS payment_turn_sum
+      FROM (SELECT DISTINCT session FROM players) p2) s ON s.session = p.session;
+
+-- credit_score is registered on every connection from the python function
+CREATE VIEW IF NOT EXISTS v_player_score AS
+SELECT session, player_id, credit_score(sum) AS score FROM v_player_score_sum;
+"""
+
+TRANSACTION_COLUMNS = "id, payment, sender_id, receiver_id, desc, turn, base_from_score, base_to_score"
+
+
+# exp overflows for sums far below zero, where the sigmoid is 0. saturate there like the numpy batch scorer
+def _sql_credit_score(sum):
+    try:
+        return credit_score(sum)
+    except OverflowError:
+        return credit_score(-700)
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.create_function("credit_score", 1, _sql_credit_score, deterministic=True)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# the session's transactions in the file, with the parts of TransactionStore the scans and checks use
+class SqliteTransactionLog:
+
+    def __init__(self, db):
+        self.db = db
+
+    def __len__(self):
+        return self.db._query("SELECT COUNT(*) FROM transactions WHERE session = ?", (self.db.session,))[0][0]
+
+    # the rows are in the file, not in memory
+    def nbytes(self):
+        return 0
+
+    def __iter__(self):
+        return iter(self.db._transactions("session = ?", (self.db.session,)))
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        found = self.db._transactions("session = ?", (self.db.session,), f"LIMIT 1 OFFSET {int(row)}")
+        if not found:
+            raise IndexError(row)
+        return found[0]
+
+
+class SqliteDatabase(Database):
+
+    def __init__(self, id_gen, size, path, session):
+        super().__init__(id_gen, size)
+        self.path = path
+        self.session = session
+        self.transactions = SqliteTransactionLog(self)
+        self._open()
+
+        # a new game replaces whatever an earlier game of the session left in the file
+        for table in ("players", "transactions", "debts", "long_terms"):
+            self.conn.execute(f"DELETE FROM {table} WHERE session = ?", (session,))
+        self.conn.commit()
+
+    def _open(self):
+        self.conn = connect(self.path)
+        self.conn_lock = threading.Lock()  # readers of a session share it, the connection is not reentrant
+        self.pending_transactions = []
+        self.dirty = {"players": set(), "debts": set(), "long_terms": set()}
+
+    # the connection does not pickle, the rows stay in the file and the copy reconnects to it.
+    # queued transactions go with the copy, they may not be in the file yet
+    def __getstate__(self):
+        state = super().__getstate__()
+        for name in ("conn", "conn_lock", "dirty"):
+            del state[name]
+        state["pending_transactions"] = list(self.pending_transactions)
+        return state
+
+    # a journal snapshot can be older than the file, and replaying the log after it writes the later
+    # rows again. so the file is put back to the copy: later transactions are deleted, queued ones are
+    # written, and the players, debts and long terms are rewritten from the copy
+    def __setstate__(self, state):
+        pending = state.pop("pending_transactions", [])
+        super().__setstate__(state)
+        self._open()
+        with self.conn_lock:
+            conn = self.conn
+            conn.execute("DELETE FROM transactions WHERE session = ? AND version > ?", (self.session, self.version))
+            conn.executemany("INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", pending)
+            for table in ("players", "debts", "long_terms"):
+                conn.execute(f"DELETE FROM {table} WHERE session = ?", (self.session,))
+            self.dirty = {"players": set(self.players_by_id), "debts": set(self.debts_by_id), "long_terms": set(self.long_terms)}
+            self._flush()
+            conn.commit()
+
+    def touch(self, kind, id):
+        super().touch(kind, id)
+        self.dirty[kind].add(id)
+
+    def add_transaction(self, transaction):
+        # both sides' money changed
+        self.version += 1
+        self.changed["players"][transaction.sender_id] = self.version
+        self.changed["players"][transaction.reciever_id] = self.version
+        t = transaction
+        self.pending_transactions.append((
+            self.session, t.id, t.payment, t.sender_id, t.reciever_id, t.desc, int(t.turn),
+            t.base_from_score, t.base_to_score, self.version,
+        ))
+
+    # queued writes to the file, called with conn_lock held. reads on the connection see them before commit
+    def _flush(self):
+        conn = self.conn
+        if self.pending_transactions:
+            conn.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending_transactions)
+            self.pending_transactions = []
+        players, debts, long_terms = self.dirty["players"], self.dirty["debts"], self.dirty["long_terms"]
+        if players:
+            conn.executemany("INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?, ?, ?)", [
+                (self.session, p.id, p.name, p.location_idx, p.interest_rate, p.turns)
+                for p in map(self.get_player, players) if p is not None
+            ])
+            players.clear()
+        if debts:
+            conn.executemany("INSERT OR REPLACE INTO debts VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (self.session, d.id, d.debtee_id, d.loaner_id, d.start_turn, d.amount, d.interest_rate)
+                for d in map(self.get_debt, debts) if d is not None
+            ])
+            debts.clear()
+        if long_terms:
+            live = [l for l in map(self.get_long_term, long_terms) if l is not None]
+            removed = [(self.session, id) for id in long_terms if self.get_long_term(id) is None]
+            conn.executemany("INSERT OR REPLACE INTO long_terms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+                (self.session, l.id, l.receiver_id, l.sender_id, l.start_turn, l.end_turn, l.desc,
+                 l.amount, l.interest_rate, l.sender_score, l.receiver_score)
+                for l in live
+            ])
+            conn.executemany("DELETE FROM long_terms WHERE session = ? AND id = ?", removed)
+            long_terms.clear()
+
+    def commit(self):
+        with self.conn_lock:
+            self._flush()
+            self.conn.commit()
+
+    def _query(self, sql, params):
+        with self.conn_lock:
+            self._flush()
+            return self.conn.execute(sql, params).fetchall()
+
+    # counted without _flush, which would write a running request's queued rows partway through it.
+    # under conn_lock no flush is running, so the queued rows are not in the file yet
+    def transaction_count(self):
+        with self.conn_lock:
+            stored = self.conn.execute("SELECT COUNT(*) FROM transactions WHERE session = ?", (self.session,)).fetchone()[0]
+            return stored + len(self.pending_transactions)
+
+    def _transactions(self, where, params, tail=""):
+        rows = self._query(f"SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE {where} ORDER BY id {tail}", params)
+        return [Transaction(*row) for row in rows]
+
+    # the same selection as TransactionStore.select, as a WHERE clause
+    def _selection(self, after_id, turn_from, turn_to, player_id, counterparty):
+        if player_id is None and counterparty is not None:
+            player_id, counterparty = counterparty, None
+        clauses, params = ["session = ?"], [self.session]
+        if after_id is not None:
+            clauses.append("id > ?")
+            params.append(after_id)
+        if turn_from is not None:
+            clauses.append("turn >= ?")
+            params.append(turn_from)
+        if turn_to is not None:
+            clauses.append("turn <= ?")
+            params.append(turn_to)
+        if player_id is not None and counterparty is None:
+            clauses.append("(sender_id = ? OR receiver_id = ?)")
+            params += [player_id, player_id]
+        elif player_id is not None:
+            clauses.append("((sender_id = ? AND receiver_id = ?) OR (receiver_id = ? AND sender_id = ?))")
+            params += [player_id, counterparty, player_id, counterparty]
+        return " AND ".join(clauses), params
+
+    def get_transactions(self):
+        return list(self.transactions)
+
+    def query_transactions(self, after_id=None, limit=None, turn_from=None, turn_to=None, player_id=None, counterparty=None):
+        where, params = self._selection(after_id, turn_from, turn_to, player_id, counterparty)
+        return self._transactions(where, params, "" if limit is None else f"LIMIT {int(limit)}")
+
+    # pages by id after the session lock is released, bounded by the last id when it is called
+    def transaction_chunks(self, size, after_id=None, turn_from=None, turn_to=None, player_id=None, counterparty=None):
+        where, params = self._selection(None, turn_from, turn_to, player_id, counterparty)
+        last_id = self._query("SELECT MAX(id) FROM transactions WHERE session = ?", (self.session,))[0][0]
+
+        def chunks(cursor):
+            while last_id is not None:
+                chunk = self._transactions(f"{where} AND id > ? AND id <= ?", params + [cursor, last_id], f"LIMIT {int(size)}")
+                if not chunk:
+                    return
+                yield chunk
+                cursor = chunk[-1].id
+
+        return chunks(-1 if after_id is None else after_id)
+
+    def transactions_since(self, since):
+        return self._transactions("session = ? AND version > ?", (self.session, since))
+
+    def player_money(self, id):
+        received, sent = self._query(
+            "SELECT (SELECT COALESCE(SUM(payment), 0) FROM transactions WHERE session = ? AND receiver_id = ?),"
+            " (SELECT COALESCE(SUM(payment), 0) FROM transactions WHERE session = ? AND sender_id = ?)",
+            (self.session, id, self.session, id),
+        )[0]
+        return STARTING_MONEY + received - sent
+
+    def player_score(self, id):
+        if self.get_player(id) is None:
+            raise AttributeError(f"no player {id}")
+        return self._query("SELECT score FROM v_player_score WHERE session = ? AND player_id = ?", (self.session, id))[0][0]
+
+    def all_player_scores(self):
+        scores = dict(self._query("SELECT player_id, score FROM v_player_score WHERE session = ?", (self.session,)))
+        return {p.id: float(scores[p.id]) for p in self.players}
+
+
+if metrics.enabled():
+    metrics.instrument_class(SqliteDatabase)
@@ -0,0 +1,110 @@
+import contextlib
+import io
+import random
+import sys
+import threading
+
+import server
+
+SESSIONS = ["stress-a", "stress-b", "stress-c"]
+THREADS = 16
+OPS_PER_THREAD = 400
+PLAYERS_PER_SESSION = 4
+
+
+# one worker hammering random sessions with a mix of turns and reads
+def worker(seed, player_ids, errors):
+    rnd = random.Random(seed)
+    client = server.app.test_client()
+    actions = [a for a in server.ACTION_HANDLERS]
+    cursors = {}  # session -> cursor from this worker's last /changes poll
+    try:
+        for _ in range(OPS_PER_THREAD):
+            session = rnd.choice(SESSIONS)
+            player_id = rnd.choice(player_ids[session])
+            op = rnd.random()
+            if op < 0.2:
+                r = client.post(f"/{session}/run_action", json={"action": rnd.choice(actions), "player_id": player_id})
+            elif op < 0.3:
+                r = client.post(f"/{session}/borrow_debt", json={"player_id": player_id, "amount": rnd.randint(1, 500)})
+            elif op < 0.4:
+                r = client.post(f"/{session}/move_player_rel", json={"player_id": player_id, "n": rnd.randint(1, 11)})
+            elif op < 0.5:
+                r = client.post(f"/{session}/player_advance_turn", json={"player_id": player_id})
+            elif op < 0.55:
+                r = client.post(f"/{session}/add_player", json={"name": f"extra {seed}"})
+            elif op < 0.6:
+                r = client.post(f"/{session}/batch", json={"ops": [
+                    {"op": "move", "player_id": player_id, "n": rnd.randint(1, 11)},
+                    {"op": "money", "player_id": player_id},
+                    {"op": "advance_turn", "player_id": player_id},
+                ]})
+            elif op < 0.75:
+                r = client.post(f"/{session}/player_money", json={"id": player_id})
+            elif op < 0.85:
+                r = client.post(f"/{session}/player_score", json={"id": player_id})
+            elif op < 0.95:
+                r = client.post(f"/{session}/player_bank_statement", json={"player_id": player_id, "limit": 20})
+            else:
+                r = client.get(f"/{session}/changes", query_string={"since": cursors.get(session, "")})
+                if r.status_code == 200:
+                    cursors[session] = r.get_json()["version"]
+            if r.status_code != 200:
+                errors.append(f"{r.request.path}: {r.status_code}")
+    except Exception as e:
+        errors.append(repr(e))
+
+
+# invariants that break when two requests interleave inside one session
+def check_session(session):
+    problems = []
+    with server.sessions.read(session) as db:
+        ids = list(db.transactions.ids)
+        if ids != list(range(len(ids))):
+            problems.append("transaction ids are not unique and in order")
+        player_ids = [p.id for p in db.players]
+        if len(set(player_ids)) != len(player_ids):
+            problems.append("duplicate player ids")
+        contract_ids = [d.id for d in db.debts] + list(db.long_terms)
+        if len(set(contract_ids)) != len(contract_ids):
+            problems.append("duplicate debt or long term ids")
+        if sum(m - server.STARTING_MONEY for m in db.balances.values()) != 0:
+            problems.append("money was created or destroyed")
+        if db.check_balances():
+            problems.append(f"ledger disagrees with a full scan for {db.check_balances()}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            mismatched = db.check_scores()
+        if mismatched:
+            problems.append(f"score aggregates disagree with a full scan for {mismatched}")
+    return problems
+
+
+if __name__ == "__main__":
+    client = server.app.test_client()
+    player_ids = {}
+    for session in SESSIONS:
+        client.get(f"/{session}/new")
+        player_ids[session] = [
+            client.post(f"/{session}/add_player", json={"name": f"Player {i}"}).get_json()["id"]
+            for i in range(PLAYERS_PER_SESSION)
+        ]
+
+    errors = []
+    threads = [threading.Thread(target=worker, args=(seed, player_ids, errors)) for seed in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    failed = bool(errors)
+    for error in errors[:10]:
+        print(f"request failed: {error}")
+    for session in SESSIONS:
+        problems = check_session(session)
+        failed = failed or bool(problems)
+        with server.sessions.read(session) as db:
+            print(f"{session}: {len(db.transactions)} transactions, {len(db.players)} players, {'ok' if not problems else 'BROKEN'}")
+        for problem in problems:
+            print(f"  {problem}")
+
+    sys.exit(1 if failed else 0)